@@ -0,0 +1,303 @@
+#!/usr/local/python/3.4.0/bin/python3
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess as sub
+import sys
+import tempfile
+import time
+
+SCRIPTS = ['sort_miranda', 'sort_RNAfold', 'mirprof_analysis', 'mirprof2table']
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+description='''
+This script will benchmark sort_miranda.py, sort_RNAfold.py,
+mirprof_analysis.py and mirprof2table.py on synthetic inputs.
+
+For every scale, seeded generators write a TransDecoder .gff3, '>>'
+miranda output, an RNAfold file, a target-predict .csv, a mirProf FASTA
+and a mirProf .csv with that many records each. Every script is then
+run end to end as its own process, timed and measured for peak RSS,
+with its 3'UTR and RNAfold caches removed first, and the stage times
+and counters it reports with --metrics-json are kept.
+
+Results are written as JSON with records/s per script and per stage,
+so runs of different versions can be compared.
+
+Default usage:
+
+	benchmark.py results.json
+	benchmark.py results.json --scales 1000,100000,10000000 --seed 7 --keep bench/
+''')
+parser.add_argument('outfile', help = 'Name for JSON results file')
+parser.add_argument('--scales', default='1000,10000,100000', help='''
+	Comma separated numbers of records per input (default=1000,10000,100000)''')
+parser.add_argument('--seed', type=int, default=1, help='''
+	Seed of the input generators (default=1)''')
+parser.add_argument('--scripts', default=','.join(SCRIPTS), help='''
+	Comma separated scripts to benchmark (default=all four)''')
+parser.add_argument('--keep', default=None, help='''
+	Write inputs and outputs to this directory and keep them
+	(default=temporary directory)''')
+
+SCRIPT_DIR 	= os.path.dirname(os.path.abspath(__file__))
+SPECIES 	= ['aae', 'ame', 'bmo', 'cel', 'dme', 'dps', 'hsa', 'mmu', 'tca', 'xtr']
+
+# ------------------------------------------------------------------------------------------------
+
+def make_transcripts(rng, n):
+	"""Returns list of (transcript, length) for n records."""
+	return [('TRINITY_DN%d_c0_g1_i1' % i, rng.randint(300, 3000))
+			for i in range(max(50, n//20))]
+
+
+def write_gff3(path, transcripts, rng):
+	"""Writes TransDecoder style .gff3 with a gene, mRNA, CDS and, for
+	most transcripts, one or two three_prime_UTR features."""
+
+	with open(path, 'w') as gff:
+		for (t, length) in transcripts:
+			strand = rng.choice('+-')
+			cds_end = rng.randint(length//3, length-60)
+			gff.write('%s\ttransdecoder\tgene\t1\t%d\t.\t%s\t.\tID=%s.g\n' % (t, length, strand, t))
+			gff.write('%s\ttransdecoder\tmRNA\t1\t%d\t.\t%s\t.\tID=%s.p1;Parent=%s.g\n' % (t, length, strand, t, t))
+			gff.write('%s\ttransdecoder\tCDS\t1\t%d\t.\t%s\t0\tID=cds.%s.p1;Parent=%s.p1\n' % (t, cds_end, strand, t, t))
+			if rng.random() < 0.8:
+				start = cds_end+1
+				for u in range(rng.randint(1, 2)):
+					if start >= length:
+						break
+					end = rng.randint(start, length)
+					gff.write('%s\ttransdecoder\tthree_prime_UTR\t%d\t%d\t.\t%s\t.\tID=%s.utr3p%d;Parent=%s.p1\n'
+							% (t, start, end, strand, t, u+1, t))
+					start = end+1
+
+
+def fold(rng, length):
+	"""Returns a random dot-bracket structure of length made of hairpins."""
+	parts = list()
+	size = 0
+	while size < length:
+		spacer 	= '.'*rng.randint(0, 12)
+		stem 	= rng.randint(3, 12)
+		loop 	= rng.randint(3, 10)
+		hairpin = '('*stem + '.'*loop + ')'*stem
+		if size+len(spacer)+len(hairpin) > length:
+			parts.append('.'*(length-size))
+			break
+		parts.append(spacer+hairpin)
+		size += len(spacer)+len(hairpin)
+	return ''.join(parts)
+
+
+def write_rnafold(path, transcripts, rng):
+	"""Writes RNAfold output: header, sequence, structure and MFE."""
+	with open(path, 'w') as rnafold:
+		for (t, length) in transcripts:
+			rnafold.write('>%s\n%s\n%s (%6.2f)\n' % (t, ''.join(rng.choices('ACGU', k=length)),
+					fold(rng, length), -rng.uniform(length/20, length/4)))
+
+
+def group_sizes(rng, n, mean):
+	"""Splits n records into groups of about mean records."""
+	sizes = list()
+	while n > 0:
+		size = min(n, rng.randint(1, 2*mean))
+		sizes.append(size)
+		n -= size
+	return sizes
+
+
+def write_miranda(path, transcripts, n, rng):
+	"""Writes n miranda '>>' summary lines grouped by miRNA. Scores and
+	energies straddle the default sort_miranda.py thresholds."""
+	with open(path, 'w') as miranda:
+		for (m, size) in enumerate(group_sizes(rng, n, 200)):
+			for _ in range(size):
+				(t, length) = rng.choice(transcripts)
+				positions = ' '.join([str(rng.randint(1, length-25)) for _ in range(rng.randint(1, 3))])
+				miranda.write('>>bmo-miR-%d\t%s\t%.2f\t%.2f\t%.2f\t%.2f\t1\t22\t%d\t %s\n'
+						% (m, t, rng.uniform(80, 200), -rng.uniform(5, 40),
+						   rng.uniform(80, 160), -rng.uniform(5, 30), length, positions))
+
+
+def write_targets(path, transcripts, n, rng):
+	"""Writes target-predict .csv with n target sites grouped by miRNA."""
+	with open(path, 'w') as csv:
+		csv.write('sRNA ID,Target ID,Coordinates,Score\n')
+		for (m, size) in enumerate(group_sizes(rng, n, 200)):
+			for _ in range(size):
+				(t, length) = rng.choice(transcripts)
+				start = rng.randint(1, length-25)
+				csv.write('bmo-miR-%d,%s,%d-%d,%.1f\n' % (m, t, start, start+21, rng.uniform(0, 5)))
+			if rng.random() < 0.05:
+				csv.write('bmo-miR-%d,No target found\n' % m)
+
+
+def write_mirprof_fasta(path, n, rng):
+	"""Writes n mirProf reads (>species-miRNA_match_countx) grouped by
+	species and miRNA."""
+	with open(path, 'w') as fasta:
+		mirnas = ['miR-%d' % i for i in range(max(10, n//50))]
+		written = 0
+		while written < n:
+			species = rng.choice(SPECIES)
+			mirna 	= rng.choice(mirnas)
+			for _ in range(min(n-written, rng.randint(1, 20))):
+				fasta.write('>%s-%s_%d_%dx\n%s\n' % (species, mirna, rng.randint(15, 24),
+						rng.randint(1, 5000), ''.join(rng.choices('ACGT', k=rng.randint(18, 25)))))
+				written += 1
+
+
+def write_mirprof_csv(path, n, rng):
+	"""Writes mirProf .csv with n miRNA count rows over all species."""
+	with open(path, 'w') as csv:
+		csv.write('"mirProf results"\n')
+		per_species = max(1, n//len(SPECIES))
+		written = 0
+		for species in SPECIES:
+			csv.write('Organism: %s,\n"miRNA","raw","weighted","normalised"\n' % species)
+			for i in rng.sample(range(max(20, n//5)), min(per_species, n-written)):
+				csv.write('"miR-%d",%d,%.1f,%.2f\n' % (i, rng.randint(1, 5000),
+						rng.uniform(1, 100), rng.uniform(0, 50)))
+				written += 1
+
+
+def write_inputs(workdir, n, seed):
+	"""Writes every synthetic input of scale n. Returns dict of paths."""
+
+	rng = random.Random(seed)
+	paths = dict((name, os.path.join(workdir, name)) for name in
+			['transcripts.gff3', 'targets.rnafold', 'hits.miranda', 'targets.csv',
+			 'mirprof.fa', 'mirprof.csv', 'plist.txt'])
+	transcripts = make_transcripts(rng, n)
+	write_gff3(paths['transcripts.gff3'], transcripts, rng)
+	write_rnafold(paths['targets.rnafold'], transcripts, rng)
+	write_miranda(paths['hits.miranda'], transcripts, n, rng)
+	write_targets(paths['targets.csv'], transcripts, n, rng)
+	write_mirprof_fasta(paths['mirprof.fa'], n, rng)
+	write_mirprof_csv(paths['mirprof.csv'], n, rng)
+	with open(paths['plist.txt'], 'w') as plist:
+		plist.write('\n'.join(rng.sample(SPECIES, len(SPECIES)))+'\n')
+	return paths
+
+# ------------------------------------------------------------------------------------------------
+
+def commands(paths, workdir):
+	"""Returns dict of script and tuple (argv, stdout file) of its run.
+	Every run writes its own stage times with --metrics-json."""
+	def script(name):
+		return [sys.executable, os.path.join(SCRIPT_DIR, name+'.py'),
+				'--metrics-json', os.path.join(workdir, name+'.metrics.json')]
+	out = lambda name: os.path.join(workdir, name)
+	return {
+		'sort_miranda': (script('sort_miranda') + [paths['hits.miranda'],
+				paths['transcripts.gff3'], out('sort_miranda.out')], None),
+		'sort_RNAfold': (script('sort_RNAfold') + [paths['targets.rnafold'],
+				paths['targets.csv'], paths['transcripts.gff3']], out('sort_RNAfold.out')),
+		'mirprof_analysis': (script('mirprof_analysis') + [paths['mirprof.fa'],
+				paths['mirprof.csv'], paths['plist.txt'], out('mirprof_analysis.out')], None),
+		'mirprof2table': (script('mirprof2table') + [paths['mirprof.fa'],
+				out('mirprof2table.out')], None)}
+
+
+def clear_caches(paths):
+	"""Removes the 3'UTR and RNAfold caches so every run starts cold."""
+	for path in (paths['transcripts.gff3']+'.utr.npz', paths['targets.rnafold']+'.idx'):
+		if os.path.exists(path):
+			os.remove(path)
+
+
+def run_script(argv, stdout_path):
+	"""Runs one script to completion. Returns dict of wall seconds, peak
+	RSS in MB of the process and its return code, plus the end of
+	stderr if it failed."""
+
+	stdout = open(stdout_path, 'w') if stdout_path else open(os.devnull, 'w')
+	stderr = tempfile.TemporaryFile()
+	start = time.perf_counter()
+	try:
+		proc = sub.Popen(argv, stdout=stdout, stderr=stderr)
+		(pid, status, usage) = os.wait4(proc.pid, 0)
+		seconds = time.perf_counter()-start
+		proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+	finally:
+		stdout.close()
+
+	result = {'seconds': seconds, 'peak_rss_mb': usage.ru_maxrss/1024.0,
+			  'returncode': proc.returncode}
+	if proc.returncode != 0:
+		stderr.seek(0)
+		result['error'] = stderr.read().decode(errors='replace').strip().split('\n')[-1]
+	stderr.close()
+	return result
+
+# ------------------------------------------------------------------------------------------------
+
+def version():
+	"""Returns the git commit of the scripts, None outside a checkout."""
+	try:
+		return sub.check_output(['git', 'rev-parse', 'HEAD'], cwd=SCRIPT_DIR,
+				stderr=sub.DEVNULL).decode().strip()
+	except (OSError, sub.CalledProcessError):
+		return None
+
+
+def rate(records, seconds):
+	return records/seconds if seconds > 0 else None
+
+
+def main():
+
+	scales 	= [int(float(s)) for s in args.scales.split(',')]
+	scripts = args.scripts.split(',')
+	for script in scripts:
+		if script not in SCRIPTS:
+			parser.error('unknown script '+script)
+
+	results = {'version': version(), 'python': platform.python_version(),
+			   'seed': args.seed, 'runs': list()}
+	root 	= args.keep or tempfile.mkdtemp(prefix='benchmark.')
+
+	try:
+		for n in scales:
+			workdir = os.path.join(root, str(n))
+			os.makedirs(workdir, exist_ok=True)
+			print(">>> Writing inputs of %d records." % n)
+			start = time.perf_counter()
+			paths = write_inputs(workdir, n, args.seed)
+			print(">>> Inputs written in %.1f s." % (time.perf_counter()-start))
+
+			runs = commands(paths, workdir)
+			for script in scripts:
+				clear_caches(paths)
+				result = run_script(*runs[script])
+				result.update({'script': script, 'records': n,
+							   'records_per_s': rate(n, result['seconds'])})
+				reported = os.path.join(workdir, script+'.metrics.json')
+				if os.path.exists(reported):
+					with open(reported) as fh:
+						result['metrics'] = json.load(fh)
+					os.remove(reported)
+					result['stages'] = dict((stage, {'seconds': seconds,
+							'records_per_s': rate(n, seconds)})
+							for (stage, seconds) in result['metrics']['stages'].items())
+				results['runs'].append(result)
+				print(">>> %s\t%d records\t%.2f s\t%.1f MB%s" % (script, n, result['seconds'],
+						result['peak_rss_mb'], '' if result['returncode'] == 0 else '\tFAILED'))
+	finally:
+		if args.keep is None:
+			shutil.rmtree(root, ignore_errors=True)
+
+	with open(args.outfile, 'w') as outfile:
+		json.dump(results, outfile, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+	main()
+	print(">>> Script complete.")
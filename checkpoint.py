@@ -0,0 +1,191 @@
+"""
+Checkpoints for resumable sort_miranda.py and sort_RNAfold.py runs.
+
+After each completed miRNA group a run records the byte offset in its
+input where the next group starts and the size of the output written so
+far. --resume truncates the output back to that size and continues
+reading the input from that offset, once the fingerprints of every
+input file and the parameters that shape the output are verified to be
+unchanged.
+
+The checkpoint is a small JSON file replaced atomically, so a run killed
+while saving it leaves the previous checkpoint intact. The output and
+then the checkpoint are fsynced on every save, so a checkpoint never
+refers to output lost in a crash of the machine; --checkpoint-interval
+bounds what that costs.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import transdecoder
+
+# Options shared by the resumable scripts
+parser = argparse.ArgumentParser(add_help=False)
+parser.add_argument('--checkpoint', default=None, help='''
+	Save a checkpoint to this file after each completed miRNA group
+	- Groups are written as they complete instead of at the end
+	- Removed once the run completes''')
+parser.add_argument('--resume', action='store_true', help='''
+	Continue a killed run from its --checkpoint
+	- Fails if an input file or an output option changed since''')
+parser.add_argument('--checkpoint-interval', type=float, default=0, help='''
+	Save the checkpoint at most once per this many seconds (default=0,
+	after every group)''')
+
+VERSION = 1
+
+# Options that do not change the output, so a run may resume with others
+RUNTIME_OPTIONS = ('resume', 'checkpoint', 'checkpoint_interval', 'jobs', 'cache_size',
+				   'chunk_size', 'index', 'profile', 'metrics_json')
+
+# File name options, compared as absolute paths so a run may resume from
+# another directory
+PATH_OPTIONS = ('miranda', 'fasta', 'infile', 'transdecoder', 'outfile')
+
+# ------------------------------------------------------------------------------------------------
+
+class LineReader:
+	"""Iterates over the decoded lines of path that begin at a byte offset
+	in [start, stop), with universal newlines as in text mode. start must
+	be a line start. offset is the byte offset of the line returned last
+	and end the offset just after it; both are where reading stopped once
+	all lines are read."""
+
+	def __init__(self, path, start=0, stop=None):
+		self.handle = open(path, 'rb')
+		self.handle.seek(start)
+		self.stop 	= stop
+		self.offset = start
+		self.end 	= start
+
+	def __iter__(self):
+		for line in self.handle:
+			if self.stop is not None and self.end >= self.stop:
+				break
+			self.offset = self.end
+			self.end 	+= len(line)
+			yield line.decode().replace('\r\n', '\n')
+		self.offset = self.end
+
+	def close(self):
+		self.handle.close()
+
+
+def fingerprint(path):
+	"""Returns JSON-able fingerprint of path (see transdecoder.fingerprint)."""
+	(stamp, digest) = transdecoder.fingerprint(path)
+	return [int(x) for x in stamp] + [digest.tobytes().hex()]
+
+
+class Checkpoint:
+	"""Checkpoint file of one run of program over inputs (list of file
+	names) with args (argparse namespace).
+
+	Call resume() to get (input offset, output size) of the last saved
+	checkpoint, then save() after every completed group and finish() at
+	the end of the run. With interval > 0, save() writes at most once per
+	interval seconds."""
+
+	def __init__(self, path, program, inputs, args, interval=0):
+		self.path 		= path
+		self.interval 	= interval
+		self.saved 		= 0.0
+		self.state 		= {'version': VERSION,
+						   'program': program,
+						   'inputs': dict((os.path.abspath(p), fingerprint(p)) for p in inputs),
+						   'parameters': dict((k, os.path.abspath(v) if k in PATH_OPTIONS and v else v)
+								for (k, v) in sorted(vars(args).items()) if k not in RUNTIME_OPTIONS),
+						   'input_offset': 0,
+						   'output_offset': 0,
+						   'groups': 0}
+
+	def resume(self):
+		"""Loads the checkpoint file. Exits with status 1 if there is none
+		or it belongs to other inputs or parameters. Returns tuple
+		(input offset, output size)."""
+
+		try:
+			with open(self.path, 'r') as fh:
+				saved = json.load(fh)
+		except (IOError, OSError, ValueError):
+			print('\tERROR: Checkpoint '+self.path+' could not be read.', file=sys.stderr)
+			raise SystemExit(1)
+
+		for key in ('version', 'program', 'inputs', 'parameters'):
+			if saved.get(key) != json.loads(json.dumps(self.state[key])):
+				print('\tERROR: Checkpoint '+self.path+' does not match this run ('+key+' changed).', file=sys.stderr)
+				raise SystemExit(1)
+
+		self.state = saved
+		return(saved['input_offset'], saved['output_offset'])
+
+	def save(self, input_offset, outfile, groups=1):
+		"""Records that open output file outfile holds every group of the
+		input before input_offset. outfile is flushed and fsynced first, so
+		the saved output size never includes rows not yet on disk."""
+
+		self.state['groups'] += groups
+		now = time.time()
+		if self.interval > 0 and now-self.saved < self.interval:
+			return
+		outfile.flush()
+		os.fsync(outfile.fileno())
+		self.state['input_offset'] 	= input_offset
+		self.state['output_offset'] = outfile.tell()
+		self.write()
+		self.saved = now
+
+	def write(self):
+		with transdecoder.replace_file(self.path, sync=True) as fh:
+			json.dump(self.state, fh)
+
+	def finish(self):
+		"""Removes the checkpoint file of a completed run."""
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+
+def open_output(path, size):
+	"""Opens output file path for appending after truncating it to size,
+	dropping anything written after the last checkpoint. Exits with
+	status 1 if it is shorter than size."""
+
+	if not os.path.exists(path) or os.path.getsize(path) < size:
+		print('\tERROR: Output '+path+' is shorter than its checkpoint.', file=sys.stderr)
+		raise SystemExit(1)
+	os.truncate(path, size)
+	return open(path, 'a')
+
+
+def check_args(parser, args):
+	"""Rejects option combinations a checkpointed run cannot honour."""
+	if args.resume and not args.checkpoint:
+		parser.error('--resume requires --checkpoint')
+	if args.checkpoint and args.sqlite:
+		parser.error('--sqlite cannot be combined with --checkpoint')
+
+
+def start_run(args, program, inputs, outfile):
+	"""Starts or, with --resume, continues a checkpointed run writing
+	outfile. Returns tuple (Checkpoint, input offset, open output file)."""
+
+	ckpt = Checkpoint(args.checkpoint, program, inputs, args, args.checkpoint_interval)
+	if not args.resume:
+		ckpt.write()
+		return(ckpt, 0, open(outfile, 'w'))
+
+	(start, size) = ckpt.resume()
+	print(">>> Resuming from checkpoint %s after %d groups." % (args.checkpoint, ckpt.state['groups']))
+	return(ckpt, start, open_output(outfile, size))
+
+
+def track(groups, lines, offsets):
+	"""Yields groups, appending to deque offsets the input offset of
+	LineReader lines as each group is yielded, i.e. where the input of
+	the groups after it starts."""
+	for group in groups:
+		offsets.append(lines.offset)
+		yield group
@@ -0,0 +1,211 @@
+"""
+Shared run instrumentation for the miRNA scripts. A run keeps named
+stage timers (GFF load, parse, filter, fold scoring, write, ...) and
+counters (lines read, hits dropped per filter, cache hits, ...) in one
+module-level Metrics object.
+
+Stages nest: time spent in an inner stage is not charged to the outer
+one, so the stage times of one thread add up to its wall time. Open
+stages are tracked per thread. Forked pool workers start from reset()
+and send take() back to be merge()d, summing stage times over workers.
+
+Every script gets --profile (cProfile) and --metrics-json through
+parser, and runs its main() with run().
+"""
+
+import argparse
+import collections
+import cProfile
+import json
+import pstats
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Options shared by every script
+parser = argparse.ArgumentParser(add_help=False)
+parser.add_argument('--profile', default=None, help='''
+	Profile the run with cProfile and write the stats to this file
+	- The slowest functions are printed at the end''')
+parser.add_argument('--metrics-json', default=None, help='''
+	Write stage times and counters of the run to this JSON file''')
+
+PROFILE_LINES = 25 # Functions printed by --profile
+
+# ------------------------------------------------------------------------------------------------
+
+class Metrics:
+	"""Stage times in seconds and counters of one run."""
+
+	def __init__(self):
+		self.begin 		= time.perf_counter()
+		self.stages 	= collections.OrderedDict() # stage, seconds
+		self.counters 	= collections.OrderedDict() # counter, value
+		self.local 		= threading.local()
+		self.lock 		= threading.Lock()
+
+	def open_stages(self):
+		"""Returns list of [stage, started] open in this thread."""
+		if not hasattr(self.local, 'stack'):
+			self.local.stack = list()
+		return self.local.stack
+
+	def start(self, name):
+		"""Opens stage name, pausing the enclosing stage."""
+		now 	= time.perf_counter()
+		stack 	= self.open_stages()
+		if stack:
+			self.charge(stack[-1][0], now-stack[-1][1])
+		stack.append([name, now])
+
+	def stop(self):
+		"""Closes the innermost stage and resumes the enclosing one."""
+		now 	= time.perf_counter()
+		stack 	= self.open_stages()
+		(name, started) = stack.pop()
+		self.charge(name, now-started)
+		if stack:
+			stack[-1][1] = now
+
+	def charge(self, name, seconds):
+		with self.lock:
+			self.stages[name] = self.stages.get(name, 0.0)+seconds
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0)+n
+
+	def elapsed(self):
+		return time.perf_counter()-self.begin
+
+	def take(self):
+		"""Returns (stages, counters) gathered so far and clears them."""
+		with self.lock:
+			taken = (dict(self.stages), dict(self.counters))
+			self.stages.clear()
+			self.counters.clear()
+		return taken
+
+	def merge(self, taken):
+		"""Adds (stages, counters) returned by take() in a worker."""
+		(stages, counters) = taken
+		for (name, seconds) in stages.items():
+			self.charge(name, seconds)
+		for (name, n) in counters.items():
+			self.count(name, n)
+
+
+RUN = Metrics()
+
+# ------------------------------------------------------------------------------------------------
+
+@contextmanager
+def stage(name):
+	"""Times the with block as stage name."""
+	RUN.start(name)
+	try:
+		yield
+	finally:
+		RUN.stop()
+
+
+def timed(iterable, name):
+	"""Yields the items of iterable, timing the production of each one as
+	stage name. Meant for streams of large items such as miRNA groups."""
+	iterator = iter(iterable)
+	while True:
+		RUN.start(name)
+		try:
+			item = next(iterator)
+		except StopIteration:
+			return
+		finally:
+			RUN.stop()
+		yield item
+
+
+def count(name, n=1):
+	"""Adds n to counter name."""
+	RUN.count(name, n)
+
+
+def reset():
+	"""Starts a new Metrics object, e.g. as initializer of pool workers."""
+	global RUN
+	RUN = Metrics()
+
+
+def take():
+	return RUN.take()
+
+
+def merge(taken):
+	RUN.merge(taken)
+
+
+def format_time(seconds):
+	m, s = divmod(seconds, 60)
+	h, m = divmod(m, 60)
+	return '%d:%02d:%02d' % (h, m, s)
+
+
+def print_time(file=None):
+	"""Prints time in hours, minutes, seconds since the run started."""
+	print(format_time(RUN.elapsed()), file=file or sys.stdout)
+
+
+def peak_rss_mb():
+	"""Returns peak resident memory in MB of this process and of its
+	largest finished child process."""
+	own 		= resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	children 	= resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+	return (own/1024.0, children/1024.0)
+
+
+def report(file=None):
+	"""Prints stage times and counters."""
+	file = file or sys.stdout
+	print(">>> Stage times:", file=file)
+	for (name, seconds) in RUN.stages.items():
+		print('\t%s\t%.3f s' % (name, seconds), file=file)
+	if RUN.counters:
+		print(">>> Counters:", file=file)
+		for (name, n) in RUN.counters.items():
+			print('\t%s\t%d' % (name, n), file=file)
+
+
+def write_json(path, program, args):
+	"""Writes program, parameters, wall time, peak RSS, stage times and
+	counters of the run to path."""
+	(own, children) = peak_rss_mb()
+	with open(path, 'w') as out:
+		json.dump({'program': program,
+				   'parameters': vars(args),
+				   'seconds': RUN.elapsed(),
+				   'peak_rss_mb': own,
+				   'peak_child_rss_mb': children,
+				   'stages': RUN.stages,
+				   'counters': RUN.counters},
+				  out, indent=2, default=str)
+
+
+def run(main, args, program, file=None):
+	"""Runs main(), under cProfile if args.profile, then prints the stage
+	report to file (default stdout) and writes --metrics-json."""
+
+	if args.profile:
+		profile = cProfile.Profile()
+		try:
+			profile.runcall(main)
+		finally:
+			profile.dump_stats(args.profile)
+			stats = pstats.Stats(args.profile, stream=file or sys.stdout)
+			stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+	else:
+		main()
+
+	report(file)
+	if args.metrics_json:
+		write_json(args.metrics_json, program, args)
@@ -1,14 +1,31 @@
 from __future__ import print_function
 from __future__ import division
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial
+from itertools import groupby, islice
+from operator import itemgetter
 import argparse
+import csv
+import gzip
+import heapq
+import multiprocessing
+import os
+import shutil
+import subprocess as sub
 import sys
+import tempfile
+import metrics
 # Requires Python 3 or newer
 
 
-parser = argparse.ArgumentParser(description='''Takes in FASTA file output 
-	from mirProf and converts it to tab-delimited table format.''')
-parser.add_argument('infile', help='Name of fasta file output from mirProf.')
-parser.add_argument('outfile', help='''Specify an output file name.''')
+parser = argparse.ArgumentParser(parents=[metrics.parser], description='''Takes in FASTA file output 
+	from mirProf and converts it to tab-delimited table format. Given several
+	input files, converts each into its own table in the outfile directory.''')
+parser.add_argument('infile', nargs='+', help='''Name of fasta file output from mirProf.
+	May be gzip or bgzip compressed (.gz).''')
+parser.add_argument('outfile', help='''Specify an output file name, or an output
+	directory if several input files are given.''')
 parser.add_argument('-g', '--grouped', type=bool, default=False, help='''Were all oragnisms
 	grouped in the outfile? True or False.''')
 parser.add_argument('-l', '--length', type=int, default=0, help='''Remove 
@@ -20,125 +37,409 @@ parser.add_argument('-c', '--collapse', type=bool, default=False, help='''True o
 parser.add_argument('-al', '--add_length', type=bool, default=False, help='''True or
 	False. Adds an additional column that specifies sequence length. Does not apply
 	if collapse is true. Default=False''')
-
-args=parser.parse_args()
-infile = open(args.infile, 'r')
-outfile = open(args.outfile, 'w')
-grouped_or_not = args.grouped
-l = int(args.length)
-collapse = args.collapse
-add_length = args.add_length
-
-
-current_mirna = None
-current_count = 0
-
-print("grouped_or_not: ", grouped_or_not)
-print("collapse: ", collapse)
-print("add_length: ", add_length)
-
-#Print header
-if(grouped_or_not is True):
-	if(collapse is True):
-		print("mirna", "count", sep="\t", end="\n", file=outfile)
-	else:
-		if(add_length is True):
-			print("mirna", "consecutive_match", "count", "length", "sequence", sep="\t", end="\n", file=outfile)
+parser.add_argument('-m', '--memory', type=float, default=1024, help='''Memory in MB
+	for collapse counts. Beyond it, partial counts are spilled to sorted temporary
+	files and merged at the end. Default=1024''')
+parser.add_argument('--tmpdir', default=None, help='''Directory for the temporary
+	files of collapse. Default=system temporary directory''')
+parser.add_argument('-v', '--views', default=None, help='''Comma separated views
+	written in one pass over each input, to <outfile>.<view>.txt: table, length
+	(table with length column), collapse, grouped (collapsed over all organisms) and
+	histogram (read length histogram per miRNA). -c and -al are then ignored.''')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='''Number of input
+	files converted at once. Default=1''')
+
+BLOCK_SIZE = 65536 # Rows handed to csv.writer.writerows at once
+ENTRY_BYTES = 256 # Rough memory of one (species, miRNA) count in a dict
+VIEWS = ('table', 'length', 'collapse', 'grouped', 'histogram')
+
+# One mirProf FASTA record; species is None if organisms were grouped
+Read = namedtuple('Read', ['species', 'mirna', 'match', 'count', 'sequence'])
+
+
+def read_records(handle, grouped=False):
+	"""Streams mirProf FASTA records as typed Read tuples.
+
+	Headers look like >aae-let-7_1_12x, or >all_combined-let-7_1_12x if
+	all organisms were grouped. The count is the full number before the x.
+	"""
+
+	header = None
+	sequence = list()
+	for line in handle:
+		if line.startswith('>'):
+			if header is not None:
+				yield parse_header(header, ''.join(sequence), grouped)
+			header = line
+			sequence = list()
 		else:
-			print("mirna", "consecutive_match", "count", "sequence", sep="\t", end="\n", file=outfile)
-else:
-	if(collapse is True):
-			print("species", "mirna", "count", sep="\t", end="\n", file=outfile)
+			sequence.append(line.strip())
+	if header is not None:
+		yield parse_header(header, ''.join(sequence), grouped)
+
+
+def parse_header(line, sequence, grouped):
+	"""Returns the Read of one header line and its sequence."""
+	if grouped:
+		#EX: >all_combined-let-7_1_1x
+		cols = line[14:].split('_')
+		species = None
+		name = cols[0]
 	else:
-		if(add_length is True):
-			print("species", "mirna", "consecutive_match", "count", "length", "sequence", sep="\t", end="\n", file=outfile)
-		else:
-			print("species", "mirna", "consecutive_match", "count", "sequence", sep="\t", end="\n", file=outfile)
-
-
-
-
-for line in infile:
-
-	if(line.startswith('>')):
-		if( grouped_or_not is True ): 
-
-			#GROUPED = TRUE
-			#EX: >all_combined-let-7_1_1x
-
-			cols = line[14:].split('_')
-
-			if(collapse is True):				
-				if(current_mirna is None): 
-					#If first mirna
-					current_mirna = cols[0]
-					current_count = int(cols[2][0])
-
-				elif(str(cols[0]) != str(current_mirna)): 
-					#If new mirna
-					print(current_mirna, current_count, sep="\t", end="\n", file=outfile)
-					current_mirna = cols[0]
-					current_count = int(cols[2][0])
-
-				else: 
-					#If same mirna
-					current_count = current_count + int(cols[2][0])
-			else:
-				if(l < int(cols[2][0])):
-					print(cols[0], cols[1], cols[2][0], sep="\t", end="\t", file=outfile)
+		#EX: >aae-let-7_1_1x
+		cols = line[1:].split('_')
+		species = cols[0][:3]
+		name = cols[0][4:]
+	return Read(species, name, cols[1], int(cols[2].strip().rstrip('x')), sequence)
+
+
+def header(grouped=False, collapse=False, add_length=False):
+	"""Returns the column names of a table."""
+	if collapse:
+		cols = ['mirna', 'count']
+	elif add_length:
+		cols = ['mirna', 'consecutive_match', 'count', 'length', 'sequence']
+	else:
+		cols = ['mirna', 'consecutive_match', 'count', 'sequence']
+	if not grouped:
+		cols.insert(0, 'species')
+	return cols
+
+
+def read_row(read, grouped=False, add_length=False):
+	"""Returns the table row of one read, in the columns of header()."""
+	row = (read.mirna, read.match, read.count)
+	if not grouped:
+		row = (read.species,) + row
+	if add_length:
+		row = row + (len(read.sequence),)
+	return row + (read.sequence,)
+
+
+def convert(records, grouped=False, length=0, collapse=False, add_length=False,
+		memory=1024, tmpdir=None):
+	"""Turns Read tuples into table rows, in the columns of header().
+
+	Without collapse, every read with a count above length is a row. With
+	collapse, reads are summed per miRNA by aggregate().
+	"""
+
+	if collapse:
+		for row in aggregate(records, grouped, memory, tmpdir):
+			yield row
+		return
+
+	for read in records:
+		if read.count <= length:
+			continue
+		yield read_row(read, grouped, add_length)
+
+
+def aggregate(records, grouped=False, memory=1024, tmpdir=None):
+	"""Sums read counts by (species, miRNA) with an Aggregator and yields
+	its rows."""
+	counts = Aggregator(grouped, memory, tmpdir)
+	for read in records:
+		counts.add(read)
+	for row in counts.rows():
+		yield row
+
+
+class Aggregator(object):
+	"""Sums read counts by (species, miRNA), whatever the input order.
+
+	Counts are kept in a dict. Whenever it holds more than memory MB worth
+	of keys it is written to a sorted temporary run file and emptied; the
+	runs and the last dict are merged by rows(). If grouped, the counts of
+	all species of a miRNA are summed.
+	"""
+
+	def __init__(self, grouped=False, memory=1024, tmpdir=None):
+		self.grouped = grouped
+		self.limit = max(1, int(memory*(1<<20)) // ENTRY_BYTES)
+		self.tmpdir = tmpdir
+		self.counts = dict()
+		self.runs = list()
+		self.tmp = None
+
+	def add(self, read):
+		key = ('' if self.grouped else read.species or '', read.mirna)
+		self.counts[key] = self.counts.get(key, 0) + read.count
+		if len(self.counts) >= self.limit:
+			if self.tmp is None:
+				self.tmp = tempfile.mkdtemp(prefix='mirprof2table.', dir=self.tmpdir)
+			self.runs.append(spill(self.counts, os.path.join(self.tmp, 'run%d.tsv' % len(self.runs))))
+			self.counts = dict()
+
+	def rows(self):
+		"""Yields (species, miRNA, count) rows, or (miRNA, count) if
+		grouped, sorted by species and miRNA. Removes the run files."""
+		try:
+			streams = [read_run(path) for path in self.runs]
+			streams.append(iter(sorted(self.counts.items())))
+			for (key, group) in groupby(heapq.merge(*streams), key=itemgetter(0)):
+				count = sum([c for (k, c) in group])
+				if self.grouped:
+					yield (key[1], count)
 				else:
-					continue
-
-		else: 
-
-			#GROUPED = FALSE
-			#EX: >aae-let-7_1_1x
-
-			cols = line[1:].split('_')
-			species = cols[0][:3]
-			name = cols[0][4:]
-
-			if(collapse is True):
-				if(current_mirna is None): 
-					#If first mirna
-					current_mirna = name
-					current_count = int(cols[2][0])
-
-				elif(str(name) != str(current_mirna)): 
-					#If new mirna
-					print(species, current_mirna, current_count, sep="\t", end="\n", file=outfile)
-					current_mirna = name
-					current_count = int(cols[2][0])
-
-				else: 
-					#If same mirna
-					current_count = current_count + int(cols[2][0])				
-
+					yield (key[0], key[1], count)
+		finally:
+			self.close()
+
+	def close(self):
+		if self.tmp is not None:
+			shutil.rmtree(self.tmp, ignore_errors=True)
+			self.tmp = None
+
+
+class Histogram(object):
+	"""Read length histogram of every (species, miRNA), weighted by read
+	count. Kept in memory: there are only a few lengths per miRNA."""
+
+	def __init__(self, grouped=False):
+		self.grouped = grouped
+		self.counts = dict()
+
+	def add(self, read):
+		key = (read.species or '', read.mirna, len(read.sequence))
+		self.counts[key] = self.counts.get(key, 0) + read.count
+
+	def rows(self):
+		"""Yields (species, miRNA, length, count) rows, without species if
+		grouped, sorted by species, miRNA and length."""
+		for ((species, mirna, length), count) in sorted(self.counts.items()):
+			if self.grouped:
+				yield (mirna, length, count)
 			else:
-				if( l < int(cols[2][0])):	
-					print(species, name, sep="\t", end="\t", file=outfile)
-					print(cols[1], cols[2][0], sep="\t", end="\t", file=outfile)
-				else:
-					continue
-
-	else:
-		# Will not print sequence if collapse is true
-		if(collapse is False and l < int(cols[2][0])):
-			if( add_length==True):
-				print(len(line.strip()), line.strip(), sep="\t", end="\n", file=outfile)
+				yield (species, mirna, length, count)
+
+	def close(self):
+		pass
+
+
+def spill(counts, path):
+	"""Writes counts sorted by key to run file path. Returns path."""
+	with open(path, 'w') as run:
+		for ((species, mirna), count) in sorted(counts.items()):
+			run.write('%s\t%s\t%d\n' % (species, mirna, count))
+	return path
+
+
+def read_run(path):
+	"""Streams ((species, miRNA), count) from a run file of spill()."""
+	with open(path, 'r') as run:
+		for line in run:
+			(species, mirna, count) = line.rstrip('\n').split('\t')
+			yield ((species, mirna), int(count))
+
+
+def write_table(rows, outfile, cols=None):
+	"""Writes rows tab-delimited, BLOCK_SIZE rows per writerows() call.
+	Returns the number of rows written."""
+
+	writer = csv.writer(outfile, delimiter='\t', lineterminator='\n')
+	if cols is not None:
+		writer.writerow(cols)
+	written = 0
+	rows = iter(rows)
+	while True:
+		with metrics.stage('convert'):
+			block = list(islice(rows, BLOCK_SIZE))
+		if not block:
+			metrics.count('rows_written', written)
+			return written
+		with metrics.stage('write'):
+			writer.writerows(block)
+		written += len(block)
+
+
+@contextmanager
+def open_fasta(path):
+	"""Opens a mirProf FASTA for reading as text, plain or gzip/bgzip.
+
+	Compressed files are decompressed by a gzip child process when one is
+	installed, so decompression runs on another core alongside parsing.
+	"""
+
+	with open(path, 'rb') as fh:
+		compressed = fh.read(2) == b'\x1f\x8b'
+	if not compressed:
+		with open(path, 'r') as fasta:
+			yield fasta
+		return
+
+	gunzip = shutil.which('gzip')
+	if gunzip is None:
+		with gzip.open(path, 'rt') as fasta:
+			yield fasta
+		return
+
+	command = [gunzip, '-dc', path]
+	proc = sub.Popen(command, stdout=sub.PIPE, universal_newlines=True, bufsize=1<<20)
+	try:
+		yield proc.stdout
+	finally:
+		proc.stdout.close()
+		proc.wait()
+	if proc.returncode != 0:
+		raise sub.CalledProcessError(proc.returncode, command)
+
+
+def table_name(infile, outdir):
+	"""Returns the output table of infile in outdir: its name without
+	.gz and FASTA extension, plus .txt."""
+	name = os.path.basename(infile)
+	if name.endswith('.gz'):
+		name = name[:-3]
+	return os.path.join(outdir, os.path.splitext(name)[0] + '.txt')
+
+
+def mirprof2table(infile, outfile, grouped=False, length=0, collapse=False, add_length=False,
+		memory=1024, tmpdir=None):
+	"""Converts mirProf FASTA file infile to table file outfile.
+	Returns the number of rows written."""
+	with open_fasta(infile) as fasta, open(outfile, 'w', newline='', buffering=1<<20) as table:
+		rows = convert(read_records(fasta, grouped), grouped, length, collapse, add_length,
+			memory, tmpdir)
+		return write_table(rows, table, header(grouped, collapse, add_length))
+
+
+def write_views(infile, prefix, views, grouped=False, length=0, memory=1024, tmpdir=None):
+	"""Converts mirProf FASTA file infile into several views in one pass.
+
+	Each view is written to <prefix>.<view>.txt:
+		table 		reads with a count above length
+		length 		table with a sequence length column
+		collapse 	counts summed by species and miRNA
+		grouped 	counts summed by miRNA over all species
+		histogram 	read length histogram of every miRNA
+
+	Returns dict of view and number of rows written.
+	"""
+
+	outfiles 	= dict() # view, open table file
+	writers 	= dict() # view, csv.writer of table/length views
+	totals 		= dict() # view, Aggregator or Histogram
+	written 	= dict()
+	try:
+		for view in views:
+			outfiles[view] = open('%s.%s.txt' % (prefix, view), 'w', newline='', buffering=1<<20)
+			if view == 'table':
+				cols = header(grouped)
+			elif view == 'length':
+				cols = header(grouped, add_length=True)
+			elif view == 'collapse':
+				cols = header(grouped, collapse=True)
+				totals[view] = Aggregator(grouped, memory, tmpdir)
+			elif view == 'grouped':
+				cols = header(True, collapse=True)
+				totals[view] = Aggregator(True, memory, tmpdir)
+			elif view == 'histogram':
+				cols = header(grouped, collapse=True)
+				cols.insert(-1, 'length')
+				totals[view] = Histogram(grouped)
 			else:
-				print(line.strip(), end="\n", file=outfile)
-
-#Gets skipped last sequence
-if(collapse is True and grouped_or_not == 1):				
-	print(current_mirna, current_count, sep="\t", end="\n", file=outfile)
-if(collapse is True and grouped_or_not == 2):
-	print(species, current_mirna, current_count, sep="\t", end="\n", file=outfile)
-
-
-
-infile.close()
-outfile.close()
-
-
-
+				raise ValueError('Unknown view '+view+'. Must be one of '+', '.join(VIEWS)+'.')
+			writer = csv.writer(outfiles[view], delimiter='\t', lineterminator='\n')
+			writer.writerow(cols)
+			written[view] = 0
+			if view not in totals:
+				writers[view] = writer
+
+		# Every view takes each block of reads before the next is read
+		with open_fasta(infile) as fasta:
+			records = read_records(fasta, grouped)
+			while True:
+				with metrics.stage('parse'):
+					block = list(islice(records, BLOCK_SIZE))
+				if not block:
+					break
+				metrics.count('reads', len(block))
+				kept = [read for read in block if read.count > length]
+				with metrics.stage('write'):
+					for (view, writer) in writers.items():
+						writer.writerows([read_row(read, grouped, view == 'length') for read in kept])
+						written[view] += len(kept)
+						metrics.count('rows_written', len(kept))
+				with metrics.stage('aggregate'):
+					for counts in totals.values():
+						for read in block:
+							counts.add(read)
+
+		for (view, counts) in totals.items():
+			written[view] = write_table(counts.rows(), outfiles[view])
+	finally:
+		for counts in totals.values():
+			counts.close()
+		for outfile in outfiles.values():
+			outfile.close()
+
+	return written
+
+
+def convert_file(paths, views=None, **options):
+	"""Pool worker converting one (infile, outfile) pair, into views if
+	given. Returns tuple (infile, outfile, rows, metrics.take())."""
+	(infile, outfile) = paths
+	if views:
+		prefix = os.path.splitext(outfile)[0]
+		rows = write_views(infile, prefix, views, options['grouped'], options['length'],
+			options['memory'], options['tmpdir'])
+		return (infile, prefix, sum(rows.values()), metrics.take())
+	return (infile, outfile, mirprof2table(infile, outfile, **options), metrics.take())
+
+
+def main():
+	print("grouped_or_not: ", args.grouped)
+	print("collapse: ", args.collapse)
+	print("add_length: ", args.add_length)
+
+	options = dict(grouped=args.grouped, length=int(args.length), collapse=args.collapse,
+		add_length=args.add_length, memory=args.memory, tmpdir=args.tmpdir)
+
+	views = None
+	if args.views:
+		views = args.views.split(',')
+		for view in views:
+			if view not in VIEWS:
+				parser.error('unknown view '+view+', must be one of '+','.join(VIEWS))
+
+	if len(args.infile) == 1:
+		if views:
+			rows = write_views(args.infile[0], args.outfile, views, options['grouped'],
+				options['length'], args.memory, args.tmpdir)
+			for view in views:
+				print(view, "->", "%s.%s.txt" % (args.outfile, view), rows[view], "rows", sep="\t")
+		else:
+			mirprof2table(args.infile[0], args.outfile, **options)
+		return
+
+	# Several inputs: one table per input in the outfile directory
+	if not os.path.isdir(args.outfile):
+		os.makedirs(args.outfile)
+	outfiles = [table_name(infile, args.outfile) for infile in args.infile]
+	if len(set(outfiles)) != len(outfiles):
+		print("ERROR: Input files map to the same output table name.")
+		raise SystemExit
+
+	jobs = max(1, min(args.jobs, len(outfiles)))
+	pairs = list(zip(args.infile, outfiles))
+	if jobs == 1:
+		results = map(partial(convert_file, views=views, **options), pairs)
+	else:
+		pool = multiprocessing.Pool(jobs, initializer=metrics.reset)
+		results = pool.imap_unordered(partial(convert_file, views=views, **options), pairs)
+	try:
+		for (infile, outfile, rows, taken) in results:
+			metrics.merge(taken)
+			metrics.count('files')
+			print(infile, "->", outfile, rows, "rows", sep="\t")
+	finally:
+		if jobs > 1:
+			pool.close()
+			pool.join()
+
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+	metrics.run(main, args, 'mirprof2table')
@@ -1,64 +1,141 @@
 from __future__ import print_function
 from Bio import SeqIO
 import argparse
+import multiprocessing
+import os
 import sys
+from functools import partial
 from operator import itemgetter
+import metrics
 
 # -----------------------------------------------------------------------------
 
-def get_counts(ranking, args):
+def get_counts(ranks, infile):
 	"""Gets count data for miRNAs whose origin species is in the priority list.
 	Args:
-		ranking: Dict in which keys = rank #, values = species
+		ranks: Dict in which keys = species, values = rank #
+		infile: name of .csv file output from mirProf
 	Returns:
 		A dict in which keys = miRNA and values are lists. Lists 
 		include species and count data. 
 
 		EXAMPLE:
-		{'miR10': [[['species1', 10, 5.8, 2.3], ['species2', 54, 54, 15.5]}
+		{'miR10': [['species1', 10, 5.8, 2.3], ['species2', 54, 54, 15.5]]}
 	"""
 
 	try:
-		infile = open(args.infile, 'r')
+		csv = open(infile, 'r')
 	except:
-		print('ERROR: Cannot open ', args.infile, '!', sep='')
+		print('ERROR: Cannot open ', infile, '!', sep='')
+		raise SystemExit
 
 	db = dict()
 	species = 0
 
-	for line in infile:
+	for line in csv:
 		if "Organism:" in line:
 			species = line.split()[1][:-1]
-		elif ("miR" in line) and ("weighted" not in line) and (species in ranking.values()):
+		elif ("miR" in line) and ("weighted" not in line) and (species in ranks):
 			cols = line.rstrip()
 			cols = cols.split(",")
 			mirna = cols[0].split('"')[1]
-			if mirna in db:
-				db[mirna].append([species, cols[1], cols[2], cols[3]])
-			else:
-				db[mirna] = [species, cols[1], cols[2], cols[3]]
+			db.setdefault(mirna, list()).append([species, cols[1], cols[2], cols[3]])
 
-	infile.close()
-	print()
+	csv.close()
 	return db
 
 
-def get_seq(name, args):
-	"""Given miRNA ID, gets FASTA sequence.
+class NameMatcher(object):
+	"""Aho-Corasick automaton over a set of miRNA names.
+
+	Finds every name that occurs as a substring of a text in one pass
+	over the text, however many names there are.
+	"""
 
-	Uses SeqIO in BioPython to parse the FASTA infile. Looks for a 
-	match in name to FASTA header.
+	def __init__(self, names):
+		self.goto = [dict()]	# state -> {character: state}
+		self.fail = [0]
+		self.out = [list()]		# names ending at each state
+
+		for name in names:
+			state = 0
+			for c in name:
+				if c not in self.goto[state]:
+					self.goto.append(dict())
+					self.fail.append(0)
+					self.out.append(list())
+					self.goto[state][c] = len(self.goto) - 1
+				state = self.goto[state][c]
+			self.out[state].append(name)
+
+		# Breadth-first so the fail state of a parent is set before its children
+		queue = list(self.goto[0].values())
+		for state in queue:
+			for c, child in self.goto[state].items():
+				queue.append(child)
+				f = self.fail[state]
+				while f and c not in self.goto[f]:
+					f = self.fail[f]
+				self.fail[child] = self.goto[f].get(c, 0)
+				self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+	def search(self, text):
+		"""Returns list of names occurring in text."""
+		found = list()
+		state = 0
+		for c in text:
+			while state and c not in self.goto[state]:
+				state = self.fail[state]
+			state = self.goto[state].get(c, 0)
+			found.extend(self.out[state])
+		return found
+
+
+def index_seqs(names, args):
+	"""Resolves FASTA sequences of many miRNA IDs in one pass over the file.
+
+	Keeps the matching rule of a linear search: the first record in file
+	order whose ID is a substring of the name, or the other way around.
+	IDs contained in a name are looked up in a dict of every substring of
+	the names; names contained in an ID are found with a NameMatcher.
 
 	Args:
-		name: miRNA ID
+		names: miRNA IDs
 	Returns:
-		string: FASTA sequence
+		dict: key = miRNA ID, value = FASTA sequence
 	"""
 
+	names = set(names)
+	substrings = dict()	# substring of a name -> names containing it
+	for name in names:
+		for i in range(len(name)):
+			for j in range(i + 1, len(name) + 1):
+				substrings.setdefault(name[i:j], set()).add(name)
+	matcher = NameMatcher(names)
+
+	seqs = dict()
 	with open(args.fasta) as fh:
 		for record in SeqIO.parse(fh, 'fasta'):
-			if record.id in name or name in record.id:
-				return(record.seq)
+			if len(seqs) == len(names):
+				break
+			for name in substrings.get(record.id, ()):
+				seqs.setdefault(name, record.seq)
+			for name in matcher.search(record.id):
+				seqs.setdefault(name, record.seq)
+	return seqs
+
+
+def get_seq(name, seqs):
+	"""Given miRNA ID, gets FASTA sequence.
+
+	Args:
+		name: miRNA ID
+		seqs: dict from index_seqs()
+	Returns:
+		string: FASTA sequence, None if no record matches
+	"""
+
+	return seqs.get(name)
 
 
 def initialize_priority_lists(plist):
@@ -84,34 +161,155 @@ def initialize_priority_lists(plist):
 	return ranking
 
 
-def pick_best_mirna(candidates, ranking):
+def rank_species(ranking):
+	"""Inverts the priority list for constant time lookups.
+	Args:
+		ranking: dict of rank # and species
+	Returns:
+		dict: key = species, value = highest rank # of the species
+	"""
+
+	ranks = dict()
+	for num_rank in sorted(ranking):
+		ranks.setdefault(ranking[num_rank], num_rank)
+	return ranks
+
+
+def pick_best_mirna(candidates, ranks):
 	"""Chooses a species as top candidate for an miRNA based on priority list.
 
-	Loops over ranked species by descending order (1st, 2nd...) and searches
-	the candidate list for a matching species. If there is a match, returns 
-	tuple in candidate list.
+	Returns the candidate whose species has the highest priority (lowest
+	rank #), the first such candidate on ties.
 
 	Args:
-		candidates: list of tuples with species and count information
-		ranking: dict of species with priority
+		candidates: list of lists with species and count information
+		ranks: dict of species with priority, from rank_species()
 	Returns:
-		tuple: top species with count information
+		list: top species with count information
 	"""
-	for x in range(1, len(ranking), 1):
-		if(len(candidates) == 4):
-			return candidates
-		for a in candidates:
-			if ranking[x] == a[0]:
-				return a
+	return min(candidates, key=lambda a: ranks[a[0]])
 
 
-def print_mirna(key, info, args, outfile):
-	"""Prints final miRNAs in a tab-delimited .txt file."""
-	print(key, end='\t')
-	print('\t'.join([x for x in info]), get_seq(key, args), sep="\t")
+def print_mirna(key, info, seqs, outfile, echo=True):
+	"""Prints final miRNAs in a tab-delimited .txt file, and to stdout
+	if echo."""
+	seq = get_seq(key, seqs)
+	if echo:
+		print(key, end='\t')
+		print('\t'.join([x for x in info]), seq, sep="\t")
 
 	print(key, end='\t', file=outfile)
-	print('\t'.join([x for x in info]), get_seq(key, args), sep="\t", file=outfile)
+	print('\t'.join([x for x in info]), seq, sep="\t", file=outfile)
+
+
+def read_manifest(manifest):
+	"""Reads the samples of a batch run.
+
+	One sample per line, either the name of a mirProf .csv file or a
+	sample name and the file name separated by a tab. Blank lines and
+	lines starting with # are skipped.
+
+	Returns:
+		list: tuples (sample, .csv file)
+	"""
+
+	try:
+		fh = open(manifest, 'r')
+	except:
+		print('ERROR: Cannot open ', manifest, '!', sep='')
+		raise SystemExit
+
+	samples = list()
+	for line in fh:
+		line = line.strip()
+		if not line or line.startswith('#'):
+			continue
+		cols = line.split('\t')
+		if len(cols) == 1:
+			samples.append((sample_name(cols[0]), cols[0]))
+		else:
+			samples.append((cols[0], cols[1]))
+	fh.close()
+	return samples
+
+
+def sample_name(path):
+	"""Names a sample after its .csv file, without directory and extension."""
+	return os.path.splitext(os.path.basename(path))[0]
+
+
+def run_batch(samples, ranks, args):
+	"""Prioritizes many mirProf samples against one FASTA and priority list.
+
+	The .csv files are parsed in args.jobs processes. The FASTA is then
+	indexed once for the miRNAs of all samples. Each sample gets its own
+	output <outdir>/<sample>.txt in the single sample format, sorted by
+	miRNA so mirprof_matrix.py can stream it, and all samples are written
+	to args.outfile as one table with a sample column.
+	"""
+
+	outdir = args.outdir or os.path.dirname(args.outfile) or '.'
+	names = [sample for (sample, infile) in samples]
+	if len(set(names)) != len(names):
+		print('ERROR: Sample names are not unique. Process halted.')
+		raise SystemExit
+	if not os.path.isdir(outdir):
+		os.makedirs(outdir)
+
+	# Get miRNA count information from all .csv files
+	print('\nBEGIN: Importing miRNA count information from', len(samples), '.csv files.')
+	files = [infile for (sample, infile) in samples]
+	with metrics.stage('parse'):
+		if args.jobs > 1 and len(files) > 1:
+			pool = multiprocessing.Pool(min(args.jobs, len(files)))
+			try:
+				dbs = pool.map(partial(get_counts, ranks), files)
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			dbs = [get_counts(ranks, infile) for infile in files]
+	metrics.count('samples', len(dbs))
+
+	for (sample, db) in zip(names, dbs):
+		if not db:
+			print('WARNING: miRNA count db of', sample, 'is empty.')
+	if not any(dbs):
+		print('ERROR: miRNA count db empty. Process halted.')
+		raise SystemExit
+	print('Successful!')
+
+	# Get FASTA sequences of the miRNAs of all samples in one pass
+	print('\nBEGIN: Indexing FASTA sequences.')
+	mirnas = set()
+	for db in dbs:
+		mirnas.update(db)
+	metrics.count('mirnas', len(mirnas))
+	with metrics.stage('fasta_index'):
+		seqs = index_seqs(mirnas, args)
+
+	# Get best miRNA hit of every sample based on priority rank
+	print('\nBEGIN: Determining best miRNA species candidates.')
+	try:
+		combined = open(args.outfile, 'w')
+	except:
+		print('ERROR: Cannont open ', args.outfile, '!', sep="")
+		raise SystemExit
+	print('sample', 'mirna', 'species', 'raw', 'weighted', 'normalised', 'sequence',
+		sep='\t', file=combined)
+
+	for (sample, db) in zip(names, dbs):
+		with metrics.stage('pick_write'):
+			outfile = open(os.path.join(outdir, sample + '.txt'), 'w')
+			for key, value in sorted(db.items()):
+				best_mirna_info = pick_best_mirna(value, ranks)
+				print_mirna(key, best_mirna_info, seqs, outfile, echo=False)
+				print(sample, end='\t', file=combined)
+				print_mirna(key, best_mirna_info, seqs, combined, echo=False)
+			outfile.close()
+		print(sample, len(db), 'miRNAs', sep='\t')
+
+	combined.close()
 
 
 # -----------------------------------------------------------------------------
@@ -119,58 +317,101 @@ def print_mirna(key, info, args, outfile):
 def main():
 
 	# Command line parameters and help
-	parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+	parser = argparse.ArgumentParser(parents=[metrics.parser],
+		formatter_class=argparse.RawDescriptionHelpFormatter,
 		description='''
 	This script will take mirProf output in which species are not 
 	grouped/collapsed and a ranked list of species in which priority is 
 	given. A representative sequence will be determined for each miRNA 
 	based on the priority list. 
 
+	Several .csv files (or a --manifest of them) are run as one batch: the 
+	FASTA and priority list are loaded once, the .csv files are read in 
+	parallel, and every sample gets an output <outdir>/<sample>.txt. The 
+	outfile is then a combined table of all samples.
+
 	Default usage:
 
 		prioritize_mirprof.py sequences.fa myresults.csv priority_list.txt outfile_name
+		prioritize_mirprof.py sequences.fa s1.csv s2.csv s3.csv priority_list.txt combined.txt -j 3
 
 	///AUTHOR: Michelle Hwang
 	///DATE: 12/11/2016''')
 	parser.add_argument('fasta', help = 'Name of fasta file output from mirProf.')
-	parser.add_argument('infile', help = 'Name of .csv file output from mirProf.')
+	parser.add_argument('infile', nargs = '*', help = '''Name of .csv file 
+		output from mirProf. Give several for a batch run.''')
 	parser.add_argument('plist', help = '''Name of text file containing 
 		priority list for species. One species per line. First species has 
 		highest priority. Please use three letter code for naming species as 
 		determined by mirbase.''')
 	parser.add_argument('outfile', help = '''Specify an output file name.''')
+	parser.add_argument('-m', '--manifest', help = '''Name of text file 
+		listing the .csv files of a batch run, one per line, optionally 
+		preceded by a sample name and a tab.''')
+	parser.add_argument('-o', '--outdir', help = '''Directory for the 
+		per sample outputs of a batch run (default: directory of outfile).''')
+	parser.add_argument('-j', '--jobs', type = int, default = 1, help = '''
+		Number of .csv files read at once in a batch run (default: 1).''')
 	args = parser.parse_args()
+	args.outfile = args.outfile.strip()
+
+	samples = [(sample_name(infile), infile) for infile in args.infile]
+	if args.manifest:
+		samples.extend(read_manifest(args.manifest))
+	if not samples:
+		parser.error('no mirProf .csv file given')
+
+	metrics.run(partial(prioritize, samples, args), args, 'mirprof_analysis')
+
+
+def prioritize(samples, args):
+	"""Runs one sample, or a batch with run_batch()."""
+
+	# Get species priority data from files
+	print('\nBEGIN: Importing species from priority list.')
+	with metrics.stage('plist'):
+		rank = initialize_priority_lists(args.plist)
+		ranks = rank_species(rank)
+	for k, v in rank.items():
+		print(k, v, sep="\t")
+
+	if args.manifest or len(samples) > 1:
+		run_batch(samples, ranks, args)
+		return
 
 	# Open and print to outfile
 	try:
-		args.outfile = args.outfile.strip()
 		outfile = open(args.outfile, 'w')
 	except:
 		print('ERROR: Cannont open ', args.outfile, '!', sep="")
 
-	# Get species priority data from files
-	print('\nBEGIN: Importing species from priority list.')
-	rank = initialize_priority_lists(args.plist)
-	for k, v in rank.iteritems():
-		print(k, v, sep="\t")
-
 	# Get miRNA count information from .csv file
 	print('\nBEGIN: Importing miRNA count information from .csv file.')
 
-	db = get_counts(rank, args)
+	with metrics.stage('parse'):
+		db = get_counts(ranks, samples[0][1])
+	metrics.count('mirnas', len(db))
+	print()
 	if not db:
 		print('ERROR: miRNA count db empty. Process halted.')
 		raise SystemExit
 	else:
 		print('Successful!')
 
+	# Get FASTA sequences of all miRNAs in one pass
+	print('\nBEGIN: Indexing FASTA sequences.')
+	with metrics.stage('fasta_index'):
+		seqs = index_seqs(db.keys(), args)
+
 	# Get best miRNA hit based on priority rank
 	print('\nBEGIN: Determining best miRNA species candidates.')
-	for key, value in db.iteritems():
-		best_mirna_info = pick_best_mirna(value, rank)
-		print_mirna(key, best_mirna_info, args, outfile)
+	with metrics.stage('pick_write'):
+		for key, value in db.items():
+			best_mirna_info = pick_best_mirna(value, ranks)
+			print_mirna(key, best_mirna_info, seqs, outfile)
 
 	outfile.close()
 
 
-main()
+if __name__ == "__main__":
+	main()
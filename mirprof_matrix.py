@@ -0,0 +1,155 @@
+from __future__ import print_function
+from array import array
+from itertools import groupby
+from operator import itemgetter
+import argparse
+import heapq
+import numpy as np
+import mirprof_analysis
+# Requires Python 3 or newer
+
+# -----------------------------------------------------------------------------
+
+def read_rows(path):
+	"""Streams (miRNA, raw count) rows of one per sample table.
+
+	Takes the per sample output of mirprof_analysis.py (mirna, species,
+	raw, weighted, normalised, sequence; no header) or a mirprof2table.py
+	table, whose header names the mirna and count columns.
+	"""
+
+	with open(path, 'r') as table:
+		mirna_col = 0
+		count_col = 2
+		for line in table:
+			cols = line.rstrip('\r\n').split('\t')
+			if not cols[0]:
+				continue
+			if cols[0] in ('mirna', 'species'):
+				mirna_col = cols.index('mirna')
+				count_col = cols.index('count')
+				continue
+			yield (cols[mirna_col], int(cols[count_col]))
+
+
+def is_sorted(path):
+	"""Checks in one pass whether the rows of a table are sorted by miRNA."""
+	last = ''
+	for (mirna, count) in read_rows(path):
+		if mirna < last:
+			return False
+		last = mirna
+	return True
+
+
+def read_counts(path):
+	"""Yields (miRNA, raw count) of one sample in miRNA order.
+
+	Rows of the same miRNA are summed. A sorted table is streamed; an
+	unsorted one is first summed into a dict, so memory stays bounded by
+	the number of distinct miRNAs of the sample either way.
+	"""
+
+	if is_sorted(path):
+		rows = read_rows(path)
+	else:
+		counts = dict()
+		for (mirna, count) in read_rows(path):
+			counts[mirna] = counts.get(mirna, 0) + count
+		rows = sorted(counts.items())
+	for (mirna, group) in groupby(rows, key=itemgetter(0)):
+		yield (mirna, sum([count for (name, count) in group]))
+
+
+def merge_counts(paths):
+	"""K-way merges the sample tables into a miRNA x sample count matrix.
+
+	Returns:
+		tuple: sorted list of miRNAs and an int64 array of raw counts with
+		one row per miRNA and one column per sample
+	"""
+
+	def tag(counts, n):
+		for (mirna, count) in counts:
+			yield (mirna, n, count)
+
+	streams = [tag(read_counts(path), n) for (n, path) in enumerate(paths)]
+	mirnas = list()
+	counts = array('q')
+	for (mirna, group) in groupby(heapq.merge(*streams), key=itemgetter(0)):
+		row = [0]*len(paths)
+		for (name, n, count) in group:
+			row[n] = count
+		mirnas.append(mirna)
+		counts.extend(row)
+
+	matrix = np.frombuffer(counts, dtype=np.int64).reshape(len(mirnas), len(paths))
+	return (mirnas, matrix)
+
+
+def normalise(matrix, scale=1e6):
+	"""Scales every sample column to counts per scale reads."""
+	totals = matrix.sum(axis=0).astype(np.float64)
+	totals[totals == 0] = 1
+	return matrix / totals * scale
+
+
+def print_matrix(mirnas, samples, raw, norm, outfile):
+	"""Prints the raw and the normalised count columns of every sample."""
+	print('mirna', *([s + '.raw' for s in samples] + [s + '.norm' for s in samples]),
+		sep='\t', file=outfile)
+	for (n, mirna) in enumerate(mirnas):
+		print(mirna, *([str(c) for c in raw[n]] + ['%.2f' % c for c in norm[n]]),
+			sep='\t', file=outfile)
+
+
+# -----------------------------------------------------------------------------
+
+def main():
+
+	# Command line parameters and help
+	parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+		description='''
+	This script will merge per sample miRNA tables into one count matrix
+	with a row per miRNA and, for every sample, a raw count column and a
+	column normalised to counts per million.
+
+	Samples are per sample outputs of mirprof_analysis.py or tables of
+	mirprof2table.py. Tables sorted by miRNA are streamed and merged in
+	one pass, so memory is bounded by the number of distinct miRNAs, not
+	by the number of rows.
+
+	Default usage:
+
+		mirprof_matrix.py s1.txt s2.txt s3.txt matrix.txt
+		mirprof_matrix.py -m samples.txt matrix.txt --npz matrix.npz''')
+	parser.add_argument('infile', nargs = '*', help = '''Name of per sample
+		table. Sample names are the file names without extension.''')
+	parser.add_argument('outfile', help = '''Specify an output file name.''')
+	parser.add_argument('-m', '--manifest', help = '''Name of text file
+		listing the tables, one per line, optionally preceded by a sample
+		name and a tab.''')
+	parser.add_argument('--npz', help = '''Also save mirnas, samples, raw
+		and norm arrays to this NumPy .npz file.''')
+	args = parser.parse_args()
+
+	samples = [(mirprof_analysis.sample_name(infile), infile) for infile in args.infile]
+	if args.manifest:
+		samples.extend(mirprof_analysis.read_manifest(args.manifest))
+	if not samples:
+		parser.error('no sample table given')
+
+	print('\nBEGIN: Merging', len(samples), 'sample tables.')
+	names = [sample for (sample, infile) in samples]
+	(mirnas, raw) = merge_counts([infile for (sample, infile) in samples])
+	norm = normalise(raw)
+	print(len(mirnas), 'miRNAs')
+
+	with open(args.outfile, 'w') as outfile:
+		print_matrix(mirnas, names, raw, norm, outfile)
+	if args.npz:
+		np.savez(args.npz, mirnas=np.array(mirnas), samples=np.array(names), raw=raw, norm=norm)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,86 @@
+"""
+Shared SQLite output backend for sort_miranda.py and sort_RNAfold.py.
+Ranked targets are bulk inserted in large transactions into an indexed
+table, so "targets of miR-X" or "miRNAs hitting transcript Y" are index
+lookups instead of scans of the flat output. Each run also records the
+program and its parameters.
+
+Example queries:
+
+	SELECT * FROM targets WHERE mirna = 'miR-X' ORDER BY rank;
+	SELECT DISTINCT mirna FROM targets WHERE target = 'Y';
+"""
+
+import json
+import sqlite3
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+	run_id 		INTEGER PRIMARY KEY,
+	program 	TEXT NOT NULL,
+	started 	TEXT NOT NULL,
+	parameters 	TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS targets (
+	run_id 				INTEGER NOT NULL REFERENCES runs(run_id),
+	mirna 				TEXT NOT NULL,
+	target 				TEXT NOT NULL,
+	rank 				INTEGER,
+	coordinates 		TEXT,
+	energy 				REAL,
+	score 				REAL,
+	max_consec_loops 	INTEGER,
+	max_consec_stems 	INTEGER,
+	ratio 				REAL
+);
+'''
+
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS targets_mirna ON targets (mirna, rank);
+CREATE INDEX IF NOT EXISTS targets_target ON targets (target);
+CREATE INDEX IF NOT EXISTS targets_score ON targets (score);
+'''
+
+# ------------------------------------------------------------------------------------------------
+
+class ResultDB:
+	"""Buffered writer of ranked targets into a SQLite database.
+
+	Rows are tuples (mirna, target, rank, coordinates, energy, score,
+	max_consec_loops, max_consec_stems, ratio), None where a program has
+	no such column. They are inserted batch_size at a time, each batch in
+	one transaction, and the indexes are built once the run is closed."""
+
+	def __init__(self, path, program, parameters, batch_size=50000):
+		self.db 		= sqlite3.connect(path)
+		self.batch_size = batch_size
+		self.rows 		= list()
+		self.db.execute('PRAGMA synchronous = OFF')
+		self.db.executescript(SCHEMA)
+		with self.db:
+			cursor = self.db.execute('INSERT INTO runs (program, started, parameters) VALUES (?, ?, ?)',
+					(program, time.strftime('%Y-%m-%d %H:%M:%S'),
+					 json.dumps(parameters, sort_keys=True, default=str)))
+		self.run_id = cursor.lastrowid
+
+	def add(self, rows):
+		"""Buffers rows and writes a batch once batch_size is reached."""
+		for row in rows:
+			self.rows.append((self.run_id,)+tuple(row))
+		if len(self.rows) >= self.batch_size:
+			self.flush()
+
+	def flush(self):
+		"""Writes buffered rows in one transaction."""
+		if not self.rows:
+			return
+		with self.db:
+			self.db.executemany('INSERT INTO targets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', self.rows)
+		self.rows = list()
+
+	def close(self):
+		"""Writes remaining rows, builds the indexes and closes."""
+		self.flush()
+		self.db.executescript(INDEXES)
+		self.db.close()
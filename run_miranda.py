@@ -0,0 +1,157 @@
+#!/usr/local/python/3.4.0/bin/python3
+
+import argparse
+import collections
+import os
+import shlex
+import subprocess as sub
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import resultdb
+import sort_miranda
+
+parser = argparse.ArgumentParser(parents=[sort_miranda.filter_parser, metrics.parser],
+formatter_class=argparse.RawDescriptionHelpFormatter,
+description='''
+This script will run miranda on a miRNA FASTA and a transcript FASTA in
+parallel shards. The stdout of every miranda process is streamed straight
+into the sort_miranda.py filters and ranking, so no miranda output is
+written to disk. The outfile has the same format as sort_miranda.py.
+
+The FASTA files are split into contiguous chunks (in a temporary
+directory, as miranda only reads files) and every miRNA chunk is run
+against every transcript chunk. Hits of one miRNA from different
+transcript chunks are joined in transcript file order, and miRNAs are
+written in miRNA FASTA order whatever the number of chunks.
+
+Default usage:
+
+	run_miranda.py mirnas.fa transcripts.fa transdecoder.gff3 outfile.txt -j 32
+	run_miranda.py mirnas.fa transcripts.fa transdecoder.gff3 outfile.txt -j 8 --miranda-args "-sc 140 -en -20"
+''')
+parser.add_argument('mirnas', help = 'Name of miRNA FASTA file.')
+parser.add_argument('transcripts', help = 'Name of transcript FASTA file.')
+parser.add_argument('transdecoder', help = 'Name of transdecoder output of transcriptome')
+parser.add_argument('outfile', help = 'Name for output file')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='''
+	Number of miranda processes run at once (default=1)''')
+parser.add_argument('--miranda-bin', default='miranda', help='''
+	Path to the miranda binary (default=miranda)''')
+parser.add_argument('--miranda-args', default='', help='''
+	Extra miranda options as one quoted string''')
+parser.add_argument('--mirna-chunks', type=int, default=0, help='''
+	Number of chunks the miRNA FASTA is split into (default=jobs)''')
+parser.add_argument('--transcript-chunks', type=int, default=1, help='''
+	Number of chunks the transcript FASTA is split into (default=1)''')
+
+# ------------------------------------------------------------------------------------------------
+
+def split_fasta(path, chunks, outdir, prefix):
+	"""Splits FASTA file into at most chunks files of contiguous records
+	of about equal size. Returns list of tuples (chunk file name, record
+	names) in order, where record names are the first words of its
+	headers, as miranda reports them."""
+
+	size 	= os.path.getsize(path)
+	step 	= max(1, -(-size // max(1, chunks)))
+	names 	= list()
+	written = 0
+	out 	= None
+
+	with open(path, 'rb') as fasta:
+		for line in fasta:
+			# Start a new chunk only at a record boundary
+			if line.startswith(b'>') and (out is None or written >= step*len(names)):
+				if out is not None:
+					out.close()
+				names.append(('%s/%s.%d.fa' % (outdir, prefix, len(names)), list()))
+				out = open(names[-1][0], 'wb')
+			if line.startswith(b'>'):
+				names[-1][1].append((line[1:].split() or [b''])[0].decode())
+			if out is not None:
+				out.write(line)
+			written += len(line)
+
+	if out is not None:
+		out.close()
+	return names
+
+
+def run_shard(mirnas, transcripts, threeprimes, miranda_bin='miranda', miranda_args='',
+		**options):
+	"""Runs miranda on one miRNA chunk and one transcript chunk and
+	streams its stdout through the sort_miranda.py filters, with the
+	3'UTR index threeprimes and the sort_miranda.parse_mirnas() keyword
+	arguments options. Returns list of unranked Mirna objects."""
+
+	command = [miranda_bin, mirnas, transcripts] + shlex.split(miranda_args)
+	proc 	= sub.Popen(command, stdout=sub.PIPE, universal_newlines=True)
+	try:
+		with metrics.stage('miranda_shards'):
+			groups = list(sort_miranda.parse_mirnas(proc.stdout, threeprimes, **options))
+	finally:
+		proc.stdout.close()
+		proc.wait()
+	if proc.returncode != 0:
+		raise sub.CalledProcessError(proc.returncode, command)
+	return groups
+
+# ------------------------------------------------------------------------------------------------
+
+def main():
+
+	threeprimes = sort_miranda.get_transdecoder_info(args.transdecoder)
+	options 	= sort_miranda.filter_options(args)
+
+	outfile = open(args.outfile, 'w')
+	db = None
+	if args.sqlite:
+		db = resultdb.ResultDB(args.sqlite, 'sort_miranda', vars(args))
+
+	with tempfile.TemporaryDirectory() as tmp:
+		with metrics.stage('split'):
+			mirna_chunks 		= split_fasta(args.mirnas, args.mirna_chunks or args.jobs, tmp, 'mirnas')
+			transcript_chunks 	= split_fasta(args.transcripts, args.transcript_chunks, tmp, 'transcripts')
+		print(">>> Running miranda on %d x %d shards." % (len(mirna_chunks), len(transcript_chunks)))
+
+		with ThreadPoolExecutor(max(1, args.jobs)) as pool:
+			shards = [[pool.submit(run_shard, m, t, threeprimes, args.miranda_bin,
+					args.miranda_args, **options) for (t, records) in transcript_chunks]
+					for (m, records) in mirna_chunks]
+
+			for (row, (chunk, records)) in zip(shards, mirna_chunks):
+				# Join groups of one miRNA chunk over all transcript chunks
+				merged = collections.OrderedDict()
+				for future in row:
+					for group in future.result():
+						if group.name in merged:
+							merged[group.name].merge(group)
+						else:
+							merged[group.name] = group
+
+				# Write in FASTA record order, not in the order the groups
+				# first kept a hit; names miranda reported otherwise go last
+				ordered = [merged.pop(name) for name in records if name in merged]
+				ordered.extend(merged.values())
+
+				# Each miRNA chunk is ranked and written once all its shards are done
+				for data in ordered:
+					with metrics.stage('rank'):
+						data.rank_targets()
+					with metrics.stage('write'):
+						sort_miranda.write_mirna(data, outfile, db)
+
+	outfile.close()
+	if db is not None:
+		with metrics.stage('write'):
+			db.close()
+	print(">>> Target filtering and ranking completed.")
+	metrics.print_time()
+
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+	metrics.run(main, args, 'run_miranda')
+	print(">>> Script complete.")
+	metrics.print_time()
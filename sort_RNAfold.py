@@ -1,15 +1,23 @@
 #!/usr/local/python/3.4.0/bin/python3
 
-import subprocess as sub
 import argparse
 import re
+import sys
 import os
-import operator
-
-parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+import mmap
+import multiprocessing
+import collections
+import heapq
+from array import array
+import numpy as np
+import transdecoder
+import resultdb
+import metrics
+import checkpoint
+
+parser = argparse.ArgumentParser(parents=[metrics.parser, checkpoint.parser],
+formatter_class=argparse.RawDescriptionHelpFormatter,
 description='''
-# Currently runs for 30 min for 6000 hits
-
 This script will take in a target-predict coordinates for predicted target sites of
 miRNA and RNAfold output of predicted secondary structures of the target mRNAs. It
 will determine whether the binding site of the miRNA on the target mRNA contains
@@ -18,6 +26,7 @@ a loop or whether it is a stem.
 Default usage:
 
 	python3 sort_RNAfold.py rnafold.fa coordinates.csv transdecoder.gff
+	python3 sort_RNAfold.py rnafold.fa coordinates.csv transdecoder.gff -o out.txt --checkpoint out.ckpt
 	python3 ~/scripts/sort_RNAfold.py Mxg.targets.rnafold Mxg.targets.csv MXG_transdecoder.gff3 > test
 
 ///AUTHOR: Michelle Hwang
@@ -25,207 +34,595 @@ Default usage:
 parser.add_argument('fasta', help 	= 'Name of hairpin file output from RNAfold.')
 parser.add_argument('infile', help 	= 'Name of .csv file output from target-predict.')
 parser.add_argument('transdecoder', help = 'Name of .gff Transdecoder output.')
+parser.add_argument('-o', '--outfile', default=None, help='''
+	Write the ranked targets to this file instead of stdout
+	- Required with --checkpoint''')
+parser.add_argument('--index', default=None, help='''
+	Name of sidecar index for the RNAfold file (default=<fasta>.idx)
+	- Compiled on first use and rebuilt when the RNAfold file changes''')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='''
+	Number of processes used to score folds (default=1)
+	- Workers share the mmapped RNAfold file through fork
+	- Output is identical to and in the same order as a serial run''')
+parser.add_argument('--cache-size', type=int, default=1000, help='''
+	Number of parsed transcript structures kept in memory (default=1000)
+	- Least recently used structures are evicted first, 0 disables''')
+parser.add_argument('-k', '--top-k', type=int, default=0, help='''
+	Keep only the K best ranked targets of each miRNA (default=0, keep all)''')
+parser.add_argument('--sqlite', default=None, help='''
+	Also write ranked targets and run parameters to this SQLite database
+	- Indexed on miRNA, target and score for fast lookups''')
+
+INDEX_MAGIC = '#sort_RNAfold.idx.2'
+INDEX_END 	= '#end' # Last line of a completely written sidecar
 
-args 	= parser.parse_args()
-infile 	= open(args.infile, 'r')
-fasta 	= open(args.fasta, 'r')
+# ------------------------------------------------------------------------------------------------
 
-hairpins = fasta.readlines()
-fasta.close()	
-print(">>> RNAfold output information collected.")
-wkdir = os.getcwd()
+class HairpinStore:
+	"""Read-only view of RNAfold output backed by mmap and a sidecar index.
+
+	The sidecar holds transcript -> byte offsets of the sequence, dotbracket
+	and energy fields plus the size and mtime of the RNAfold file it was
+	compiled from, and ends with INDEX_END. It is compiled once and reused
+	while those still match, so a run only touches the records it looks
+	up."""
+
+	def __init__(self, path, index_path=None):
+		self.path 		= path
+		self.index_path = index_path or path+'.idx'
+		self.handle 	= open(path, 'rb')
+		stat 			= os.fstat(self.handle.fileno())
+		self.stamp 		= (stat.st_size, stat.st_mtime_ns)
+		self.offsets 	= self.load_index()
+		if self.offsets is None:
+			print(">>> Compiling RNAfold index "+self.index_path+".", file=sys.stderr)
+			self.offsets = compile_hairpins(self.handle)
+			self.write_index()
+		if stat.st_size > 0:
+			self.mm = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+		else:
+			self.mm = b''
+
+	def load_index(self):
+		"""Returns offsets from the sidecar, or None if it is missing,
+		stale, truncated or otherwise unreadable."""
+		try:
+			index = open(self.index_path, 'r')
+		except IOError:
+			return None
+		with index:
+			fields = index.readline().rstrip('\n').split('\t')
+			if fields != [INDEX_MAGIC, str(self.stamp[0]), str(self.stamp[1])]:
+				return None
+			offsets = dict()
+			try:
+				for line in index:
+					if line == INDEX_END+'\n':
+						return offsets
+					cols = line.rstrip('\n').split('\t')
+					if len(cols) != 5:
+						return None
+					offsets[cols[0]] = tuple(map(int, cols[1:]))
+			except (UnicodeDecodeError, ValueError):
+				return None
+		return None # No INDEX_END, the sidecar was cut short
+
+	def write_index(self):
+		"""Writes offsets to the sidecar through a temp file of its own, so
+		concurrent runs never write the same file. Warns if it cannot be
+		written."""
+		try:
+			with transdecoder.replace_file(self.index_path) as index:
+				print(INDEX_MAGIC, self.stamp[0], self.stamp[1], sep="\t", file=index)
+				for transcript, offset in self.offsets.items():
+					print(transcript, *offset, sep="\t", file=index)
+				print(INDEX_END, file=index)
+		except (IOError, OSError):
+			print('\tWARNING: RNAfold index '+self.index_path+' could not be written.', file=sys.stderr)
+
+	def __contains__(self, target):
+		return target in self.offsets
+
+	def __getitem__(self, target):
+		"""Returns tuple (sequence, dotbracket, energy) of target."""
+		(seq_start, db_start, e_start, end) = self.offsets[target]
+		sequence 	= self.mm[seq_start:db_start].decode().strip()
+		dotbracket 	= self.mm[db_start:e_start].decode().strip()
+		energy 		= re.sub('[()]', '', self.mm[e_start:end].decode()).strip()
+		return(sequence, dotbracket, energy)
+
+	def length(self, target):
+		"""Returns length of target sequence without reading it."""
+		(seq_start, db_start, e_start, end) = self.offsets[target]
+		return(e_start - db_start)
+
+	def close(self):
+		if self.mm:
+			self.mm.close()
+		self.handle.close()
+
+
+def compile_hairpins(handle):
+	"""Takes a binary RNAfold file handle and scans it once.
+	Returns a dictionary of transcripts with values in the form of
+	a tuple (sequence offset, dotbracket offset, energy offset, end).
+	Energy offset points at the space before the parenthesised energy."""
+
+	offsets 	= dict()
+	record 		= None # [transcript, sequence offset, dotbracket offset]
+	pos 		= 0
+
+	handle.seek(0)
+	for line in handle:
+		if line.startswith(b'>'):
+			record = [line[1:].strip().split(b' ')[0].decode(), None, None]
+		elif record is not None and record[1] is None:
+			record[1] = pos
+		elif record is not None and record[2] is None:
+			record[2] = pos
+			space = line.find(b' ')
+			# Keep the first record, as the old awk | head lookup did
+			if space != -1 and record[0] not in offsets:
+				end = pos+len(line.rstrip())
+				offsets[record[0]] = (record[1], record[2], pos+space, end)
+			record = None
+		pos += len(line)
+
+	return offsets
 
 # ------------------------------------------------------------------------------------------------
 
 class Mirna:
-	def __init__(self, name):
+	"""Targets of one miRNA, in input order. Targets are ranked by
+	structure, lowest first, and with top_k only the top_k best are
+	kept while they are folded."""
+
+	__slots__ = ('name', 'top_k', 'coordinates', 'energies', 'structures', 'targets', 'ranks')
+
+	def __init__(self, name, top_k=0):
 		self.name = name
+		self.top_k = top_k
 		self.coordinates = list()
 		self.energies = list()
 		self.structures = list()
 		self.targets = list()
-		self.ranks = list()
+		self.ranks = array('l')
 
 	def add_target(self, target, coordinate):
 		self.targets.append(target)
 		self.coordinates.append(coordinate)
 
-	def determine_folds(self):
+	def determine_folds(self, folds):
+		"""Scores sites grouped by target so each structure is read once
+		from FoldCache folds.
+
+		With top_k, only the top_k best sites are kept as each target is
+		scored: heap holds (negated structure, -index, slot) with the worst
+		kept site at its root, and a better site overwrites that slot.
+		kept holds the input index of the site in each slot."""
+		sites = dict() # target, indices of its coordinates
 		for i in range(0,len(self.targets),1):
-			(structure, energy) = determine_fold(self.targets[i], self.coordinates[i])
-			self.structures.append(structure)
-			self.energies.append(energy)
+			sites.setdefault(self.targets[i], list()).append(i)
+
+		if self.top_k <= 0 or len(self.targets) <= self.top_k:
+			self.structures = [None]*len(self.targets)
+			self.energies 	= [None]*len(self.targets)
+			for target in sites:
+				coordinates = [self.coordinates[i] for i in sites[target]]
+				(structures, energy) = determine_fold(target, coordinates, folds)
+				for (i, structure) in zip(sites[target], structures):
+					self.structures[i] = structure
+					self.energies[i] = energy
+			return
+
+		heap 			= list()
+		kept 			= array('l')
+		self.structures = list()
+		self.energies 	= list()
+		for target in sites:
+			coordinates = [self.coordinates[i] for i in sites[target]]
+			(structures, energy) = determine_fold(target, coordinates, folds)
+			for (i, structure) in zip(sites[target], structures):
+				key = (-structure[0], -structure[1], -structure[2], -i)
+				if len(kept) < self.top_k:
+					heapq.heappush(heap, key+(len(kept),))
+					kept.append(i)
+					self.structures.append(structure)
+					self.energies.append(energy)
+					continue
+
+				# Ties go to the earlier site, as a stable sort would
+				if key <= heap[0][:4]:
+					continue
+				slot = heap[0][4]
+				heapq.heapreplace(heap, key+(slot,))
+				kept[slot] 				= i
+				self.structures[slot] 	= structure
+				self.energies[slot] 	= energy
+
+		# Put kept sites back in input order
+		slots 				= sorted(range(len(kept)), key=kept.__getitem__)
+		self.targets 		= [self.targets[kept[n]] for n in slots]
+		self.coordinates 	= [self.coordinates[kept[n]] for n in slots]
+		self.structures 	= [self.structures[n] for n in slots]
+		self.energies 		= [self.energies[n] for n in slots]
 
 	def rank_targets(self):
-		self.ranks = [operator.itemgetter(0)(x) for x in sorted(enumerate(self.structures,1), key=operator.itemgetter(1))]
+		"""Sets ranks[n] to the rank of target n (1 = best)."""
+		ranked = sorted(range(len(self.targets)), key=self.structures.__getitem__)
+		self.ranks = array('l', [0]*len(ranked))
+		for (rank, i) in enumerate(ranked, 1):
+			self.ranks[i] = rank
 
 	def print_mirna(self):
 		print(self.name)
-		
+
+
+class FoldProfile:
+	"""Prefix sums and run-length table of one dotbracket structure.
+
+	Window metrics for any number of sites on the transcript are computed
+	from these arrays in one vectorized call instead of slicing the string
+	and running regexes per site. Also holds the energy, as printed and as
+	a float MFE, and the base-pair partner of each position (-1 if none),
+	built on first access since scoring does not need it."""
+
+	def __init__(self, dotbracket, energy=''):
+		codes 			= np.frombuffer(dotbracket.encode(), dtype=np.uint8)
+		self.dotbracket = dotbracket
+		self.energy 	= energy
+		self.length 	= len(codes)
+		self.is_paired 	= (codes == ord('(')) | (codes == ord(')'))
+		self.is_unpaired = codes == ord('.')
+		self.paired 	= np.concatenate(([0], np.cumsum(self.is_paired, dtype=np.int32)))
+		self.unpaired 	= np.concatenate(([0], np.cumsum(self.is_unpaired, dtype=np.int32)))
+
+		# Index at which the run of identical characters at each position began
+		new_run 		= np.ones(self.length, dtype=bool)
+		new_run[1:] 	= codes[1:] != codes[:-1]
+		positions 		= np.arange(self.length, dtype=np.int32)
+		self.run_start 	= np.maximum.accumulate(np.where(new_run, positions, 0))
+
+		try:
+			self.mfe = float(energy)
+		except ValueError:
+			self.mfe = float('nan')
+
+		self._partners 	= None
+
+	@property
+	def partners(self):
+		"""Returns int32 array of the base-pair partner of each position."""
+		if self._partners is None:
+			self._partners 	= np.full(self.length, -1, dtype=np.int32)
+			opened 			= list()
+			for i in np.flatnonzero(self.is_paired).tolist():
+				if self.dotbracket[i] == '(':
+					opened.append(i)
+				elif opened:
+					j = opened.pop()
+					self._partners[i] = j
+					self._partners[j] = i
+		return self._partners
+
+	def metrics(self, windows):
+		"""Takes list of (start, stop) slice bounds on the dotbracket.
+		Returns list of tuples (max_consec_loops, max_consec_stems, ratio):
+		longest run of one bracket type, longest run of unpaired bases
+		and paired/unpaired count ratio (paired count if none unpaired)."""
+
+		if not windows:
+			return list()
+
+		bounds 	= [slice(a, b).indices(self.length) for (a, b) in windows]
+		start 	= np.array([a for (a, b, step) in bounds], dtype=np.int64)
+		stop 	= np.array([max(a, b) for (a, b, step) in bounds], dtype=np.int64)
+		width 	= int((stop-start).max())
+
+		if width == 0:
+			loops = stems = np.zeros(len(windows), dtype=np.int64)
+		else:
+			idx 	= start[:,None] + np.arange(width)[None,:]
+			inside 	= idx < stop[:,None]
+			idx 	= np.minimum(idx, self.length-1)
+			# Runs are clipped at the window start, as slicing the string did
+			run 	= idx - np.maximum(self.run_start[idx], start[:,None]) + 1
+			loops 	= np.where(inside & self.is_paired[idx], run, 0).max(axis=1)
+			stems 	= np.where(inside & self.is_unpaired[idx], run, 0).max(axis=1)
+
+		paired 		= (self.paired[stop] - self.paired[start]).tolist()
+		unpaired 	= (self.unpaired[stop] - self.unpaired[start]).tolist()
+
+		structures = list()
+		for (l, s, p, u) in zip(loops.tolist(), stems.tolist(), paired, unpaired):
+			if u == 0:
+				ratio = p
+			else:
+				ratio = p/u
+			structures.append((l, s, ratio))
+		return structures
+
+
+class FoldCache:
+	"""LRU cache of FoldProfile objects by transcript of HairpinStore
+	hairpins.
+
+	Target-predict output hits the same transcript from many miRNAs, so
+	each structure is fetched and parsed once while it stays in the cache.
+	workers holds the counters last reported by each --jobs process."""
+
+	def __init__(self, hairpins, size=1000):
+		self.hairpins 	= hairpins
+		self.size 		= size
+		self.profiles 	= collections.OrderedDict()
+		self.hits 		= 0
+		self.misses 	= 0
+		self.workers 	= dict() # pid, (hits, misses)
+
+	def get(self, target):
+		"""Returns FoldProfile of target, parsing it on a miss."""
+		profile = self.profiles.get(target)
+		if profile is not None:
+			self.hits += 1
+			self.profiles.move_to_end(target)
+			return profile
+
+		self.misses += 1
+		(d, e) 	= get_dotbracket(self.hairpins, target) #dotbracket, energy
+		profile = FoldProfile(d, e)
+		if self.size > 0:
+			self.profiles[target] = profile
+			if len(self.profiles) > self.size:
+				self.profiles.popitem(last=False)
+		return profile
+
+	def counts(self):
+		"""Returns tuple (hits, misses) summed over this process and workers."""
+		hits 	= self.hits + sum(h for (h, m) in self.workers.values())
+		misses 	= self.misses + sum(m for (h, m) in self.workers.values())
+		return(hits, misses)
+
 # ------------------------------------------------------------------------------------------------
 
-def get_transdecoder_info():
+def get_transdecoder_info(path):
 	"""Takes transdecoder .gff3 output and takes 3'UTR information.
-	Returns a dictionary of transcripts with values in the form of
-	a tuple (pos1, pos2, strand + or -). Will only take best 3'UTR 
-	region."""
+	Returns a transdecoder.UtrIndex of every 3'UTR region of each
+	transcript."""
 
-	print(">>> Attempting to gather Transdecoder .gff3 info using grep.")
+	print(">>> Attempting to gather Transdecoder .gff3 3'UTR info.", file=sys.stderr)
 
 	try:
-		lines = sub.getoutput("grep 'three_prime_UTR' "+args.transdecoder)
-		lines = lines.split('\n')
-		print(">>> Grep from Transdecoder gff file successful.")
+		with metrics.stage('gff_load'):
+			return transdecoder.load_utrs(path)
 	except IOError:
-		print('\tERROR: Transdecoder .gff3 file could not be found.')
-
-	threeprimes = dict()
-	duplicates = list()
-	current_transcript = None
-
-	for line in lines:
-		line 	= line.rstrip()
-		fields 	= line.split('\t')
-
-		transcript 	= fields[0]
-		pos1		= int(fields[3])
-		pos2 		= int(fields[4])
-		strand		= fields[6]
-
-		# Remove unlikely 3'UTRs
-		if (pos2-pos1) < 25:
-			continue 
-		elif current_transcript is transcript:
-			duplicates.append((pos1, pos2, strand, pos2-pos1))
+		print('\tERROR: Transdecoder .gff3 file could not be found.', file=sys.stderr)
+		raise SystemExit
+
+def filter_utr(data, threeprimes, hairpins):
+	"""Takes Mirna object and checks all its sites against the 3'UTR
+	index in one call, with target lengths from HairpinStore hairpins.
+	Returns Mirna object without the targets that have a 3'UTR but whose
+	site is not inside any of them."""
+
+	starts 	= list()
+	ends 	= list()
+	lengths = list()
+	for i in range(0,len(data.targets),1):
+		(start, stop) = data.coordinates[i].split('-')
+		starts.append(int(start))
+		ends.append(int(stop))
+		if data.targets[i] in threeprimes:
+			lengths.append(get_length(hairpins, data.targets[i]))
 		else:
-			if current_transcript is not None:
-				# Picks hit with shortest 3'UTR
-				top_hit = sorted_dups = sorted(duplicates, key=operator.itemgetter(0))[0]
-				threeprimes[transcript] = top_hit
-				duplicates = list()
-			current_transcript = transcript 
-			duplicates.append((pos1, pos2, strand, pos2-pos1))
-
-	return threeprimes
-
-def check_coordinate(coordinate, threeprime, transcript_len):
-	"""Returns false if target does is not in 3'UTR.
-	Take in coordinate (length, pos) and threeprime info
-	in form of (start, end, strand, length).
-	True otherwise."""
-
-	target_start = int(threeprime[0])
-	target_end	 = int(threeprime[1])
-	strand 		 = threeprime[2]
-	coordinates	 = coordinate.split('-')
-	mirna_start	 = int(coordinates[0])
-	mirna_end	 = int(coordinates[1])
-
-	if strand is '+':
-		pass
-	elif strand is '-':
-		mirna_start = transcript_len - mirna_end
-		mirna_end 	= transcript_len - mirna_start
-	else:
-		raise MyException('Invalid strand. Must be + or -.')		
-
-	if ((mirna_start >= target_start) and (mirna_end <= target_end)):
-		return True
-	
-	return False
-
-
-def determine_fold(target, coordinates):
-	dotbracket 		= get_dotbracket(target)
-	(start, stop) 	= coordinates.split('-')
-
-	d = dotbracket[0] #dotbracket
-	e = dotbracket[1] #energy
-	e = e.strip()
-	e = re.sub('[()]', '', e)
-	s = d[int(start)-1:int(stop)-1] #subseq
-
-	if re.findall(r'\(+|\)+',s):
-		max_consec_loops = max(len(n) for n in re.findall(r'\(+|\)+',s))
-	else: 
-		max_consec_loops = 0
-
-	if re.findall(r'(.)+',s):
-		max_consec_stems = max(len(n) for n in re.findall(r'(.)+',s))
-	else:
-		max_consec_stems = 0
-
-	if(s.count('.') is 0):
-		ratio = s.count('(')+s.count(')')
-	else:
-		ratio = (s.count('(')+s.count(')'))/s.count('.')
-
-	structure = (max_consec_loops, max_consec_stems, ratio)
-	return(structure, e)
-
-def get_dotbracket(target):
-	out = sub.check_output("awk '/"+target+"$/ {print FNR}' "+wkdir+"/"+args.fasta+" | head -n 1", universal_newlines=True, shell=True)
-	return(hairpins[int(out)+1].split(' '))
-
-def get_length(target):
-	out = sub.check_output("awk '/"+target+"$/ {print FNR}' "+wkdir+"/"+args.fasta+" | head -n 1", universal_newlines=True, shell=True)
-	return(len(hairpins[int(out)]))
-
-def print_out(all_mirnas):
-	for m in all_mirnas: # for each mirna
-		for n in range(1,len(all_mirnas[m].energies),1):
-			print(m, all_mirnas[m].ranks[n],
-					 all_mirnas[m].targets[n], 
-					 all_mirnas[m].coordinates[n], 
-					 all_mirnas[m].energies[n],
-					 all_mirnas[m].structures[n][0],
-					 all_mirnas[m].structures[n][1],
-					 all_mirnas[m].structures[n][2],
-					 sep="\t", end="\n")
-
-# ------------------------------------------------------------------------------------------------
-
-def main():
-
-	all_mirnas 		= dict() # all mirna names and their class objects
-	current_mirna 	= None 
-	threeprimes		= get_transdecoder_info()
-	print(">>> Transdecoder information collected.")
+			lengths.append(0)
+
+	keep 	= threeprimes.contains(data.targets, starts, ends, lengths, missing=True)
+	metrics.count('targets_dropped_utr', len(keep)-int(np.count_nonzero(keep)))
+	kept 	= Mirna(data.name, data.top_k)
+	for i in range(0,len(data.targets),1):
+		if keep[i]:
+			kept.add_target(data.targets[i], data.coordinates[i])
+	return kept
+
+
+def determine_fold(target, coordinates, folds):
+	"""Scores every site of one target in a single vectorized call, with
+	its structure from FoldCache folds. Takes a list of coordinates
+	'start-stop'. Returns a tuple
+	(structures, energy) where structures holds one tuple
+	(max_consec_loops, max_consec_stems, ratio) per coordinate."""
+
+	profile = folds.get(target)
+	windows = list()
+	for c in coordinates:
+		(start, stop) = c.split('-')
+		windows.append((int(start)-1, int(stop)-1)) #subseq
+
+	return(profile.metrics(windows), profile.energy)
+
+def get_dotbracket(hairpins, target):
+	"""Returns tuple (dotbracket, energy) of target from hairpin index."""
+	(sequence, dotbracket, energy) = hairpins[target]
+	return(dotbracket, energy)
+
+def get_length(hairpins, target):
+	"""Returns length of target sequence from hairpin index."""
+	return(hairpins.length(target))
+
+def score_mirna(data, folds):
+	"""Determines folds from FoldCache folds and ranks targets of one
+	Mirna object."""
+	with metrics.stage('fold_scoring'):
+		data.determine_folds(folds)
+	with metrics.stage('rank'):
+		data.rank_targets()
+	return data
+
+# State of a forked pool worker, set by init_worker()
+_worker = dict()
+
+def init_worker(folds):
+	"""Pool initializer. Keeps the fold cache, whose mmapped hairpin
+	store forked workers inherit instead of pickling, and starts the
+	worker's metrics."""
+	_worker['folds'] = folds
+	metrics.reset()
+
+def score_mirna_in_worker(data):
+	"""Scores one Mirna object in a pool worker. Returns tuple
+	(data, pid, cache hits, cache misses, metrics.take()) so the parent
+	can report fold cache counters and stage times of every worker."""
+	folds = _worker['folds']
+	score_mirna(data, folds)
+	return(data, os.getpid(), folds.hits, folds.misses, metrics.take())
+
+def score_mirnas(groups, folds, jobs=1):
+	"""Scores Mirna objects with FoldCache folds, in a forked pool of
+	jobs processes if jobs > 1. Yields them back in input order. At most
+	2 groups per worker are in flight, so memory stays bounded by the
+	largest miRNA group."""
+	if jobs <= 1:
+		for data in groups:
+			yield score_mirna(data, folds)
+		return
+
+	pool = multiprocessing.get_context('fork').Pool(jobs, initializer=init_worker,
+			initargs=(folds,))
+	pending = collections.deque()
+	try:
+		for data in groups:
+			pending.append(pool.apply_async(score_mirna_in_worker, (data,)))
+			if len(pending) >= 2*jobs:
+				(data, pid, hits, misses, taken) = pending.popleft().get()
+				folds.workers[pid] = (hits, misses)
+				metrics.merge(taken)
+				yield data
+		while pending:
+			(data, pid, hits, misses, taken) = pending.popleft().get()
+			folds.workers[pid] = (hits, misses)
+			metrics.merge(taken)
+			yield data
+	finally:
+		pool.terminate()
+
+def read_mirnas(infile, threeprimes, hairpins, top_k=0):
+	"""Takes target-predict .csv lines grouped by miRNA and yields one
+	Mirna object, keeping top_k targets, per group as soon as the next
+	group starts. Targets outside the 3'UTR are removed and emptied
+	groups are skipped."""
+
+	data = None # Temp container of Mirna object
 
 	for line in infile:
 
 		if "No target found" in line or "sRNA ID" in line:
 			continue 
 
+		metrics.count('csv_lines')
 		spline 		= line.split(',')
 		mirna		= spline[0]
 		target 		= spline[1]
 		coordinate 	= spline[2]
 
-		# If target location is not in the 3'UTR region:
-		if ((target in threeprimes) and (check_coordinate(coordinate, threeprimes[target], get_length(target)) is False) or coordinate is None):
-			continue	
+		if data is None or mirna != data.name:
+			if data is not None:
+				data = filter_utr(data, threeprimes, hairpins)
+				if data.targets:
+					yield data
+			data = Mirna(mirna, top_k)
+		data.add_target(target, coordinate)
+
+	# Last group
+	if data is not None:
+		data = filter_utr(data, threeprimes, hairpins)
+		if data.targets:
+			yield data
+
+def print_out(data, db=None, outfile=None):
+	"""Prints scored targets of one Mirna object to outfile (default
+	stdout), and adds them to ResultDB db if given."""
+	m = data.name
+	for n in range(0,len(data.energies),1):
+		print(m, data.ranks[n],
+				 data.targets[n], 
+				 data.coordinates[n], 
+				 data.energies[n],
+				 data.structures[n][0],
+				 data.structures[n][1],
+				 data.structures[n][2],
+				 sep="\t", end="\n", file=outfile)
+
+	if db is not None:
+		rows = list()
+		for n in range(0,len(data.energies),1):
+			try:
+				energy = float(data.energies[n])
+			except ValueError:
+				energy = None
+			rows.append((m, data.targets[n], data.ranks[n], data.coordinates[n],
+					energy, None) + tuple(data.structures[n]))
+		db.add(rows)
 
-		if(spline[0] == current_mirna):
-			data.add_target(target, coordinate)
+# ------------------------------------------------------------------------------------------------
 
-		else:
-			if(current_mirna is not None):
-				data.determine_folds()
-				data.rank_targets()
-				all_mirnas[data.name] = data
-			current_mirna = mirna
-			data = Mirna(current_mirna)
-			data.add_target(target, coordinate)
-
-	current_mirna = mirna
-	data = Mirna(current_mirna)
-	data.add_target(target, coordinate)
-	infile.close()
+def main():
+
+	threeprimes		= get_transdecoder_info(args.transdecoder)
+	print(">>> Transdecoder information collected.", file=sys.stderr)
+
+	infile 		= open(args.infile, 'r')
+	with metrics.stage('rnafold_index'):
+		hairpins = HairpinStore(args.fasta, args.index)
+	print(">>> RNAfold output information collected.", file=sys.stderr)
+	folds 		= FoldCache(hairpins, args.cache_size)
+
+	db = None
+	if args.sqlite:
+		db = resultdb.ResultDB(args.sqlite, 'sort_RNAfold', vars(args))
+
+	ckpt 	= None
+	lines 	= infile
+	outfile = sys.stdout
+	if args.checkpoint:
+		(ckpt, start, outfile) = checkpoint.start_run(args, 'sort_RNAfold',
+				[args.fasta, args.infile, args.transdecoder], args.outfile)
+		lines = checkpoint.LineReader(args.infile, start)
+	elif args.outfile:
+		outfile = open(args.outfile, 'w')
+
+	# Each miRNA group is scored, ranked and written as soon as it closes.
+	# offsets holds where the input after each group in flight starts.
+	offsets = collections.deque()
+	groups 	= read_mirnas(lines, threeprimes, hairpins, args.top_k)
+	if ckpt is not None:
+		groups = checkpoint.track(groups, lines, offsets)
+	groups 	= metrics.timed(groups, 'parse')
+	for data in metrics.timed(score_mirnas(groups, folds, args.jobs), 'fold_scoring_wait'):
+		with metrics.stage('write'):
+			print_out(data, db, outfile)
+			if ckpt is not None:
+				ckpt.save(offsets.popleft(), outfile)
 
-	print_out(all_mirnas)
+	infile.close()
+	lines.close()
+	hairpins.close()
+	if outfile is not sys.stdout:
+		outfile.close()
+	if ckpt is not None:
+		ckpt.finish()
+	if db is not None:
+		with metrics.stage('write'):
+			db.close()
+	(hits, misses) = folds.counts()
+	metrics.count('fold_cache_hits', hits)
+	metrics.count('fold_cache_misses', misses)
+	print(">>> Fold cache: %d hits, %d misses." % (hits, misses), file=sys.stderr)
 
 
 if __name__ == "__main__":
-    main()
+	args 		= parser.parse_args()
+	checkpoint.check_args(parser, args)
+	if args.checkpoint and not args.outfile:
+		parser.error('--checkpoint requires --outfile')
+	metrics.run(main, args, 'sort_RNAfold', file=sys.stderr)
 
@@ -2,20 +2,49 @@
 
 import argparse
 import os
-import operator
 import re
-import subprocess as sub
-import time
-
-parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+import collections
+import heapq
+from array import array
+import multiprocessing
+import numpy as np
+import transdecoder
+import resultdb
+import metrics
+import checkpoint
+
+# Filter and output options, shared with run_miranda.py
+filter_parser = argparse.ArgumentParser(add_help=False)
+filter_parser.add_argument('-e', '--energy', type=int, default=20, help='''
+	Energy threshold (default=20)
+	- e.g. remove those folds with larger energy values than |20|
+	- Most likely secondary structure has min free energy''')
+filter_parser.add_argument('-s', '--score', type=int, default=100, help='''
+	Score threshold (default=100)
+	- e.g. remove those matches with scores less than 100''')
+filter_parser.add_argument('-k', '--top-k', type=int, default=0, help='''
+	Keep only the K highest scoring targets of each miRNA (default=0, keep all)
+	- Kept in a bounded heap while hits are read''')
+filter_parser.add_argument('--sqlite', default=None, help='''
+	Also write ranked targets and run parameters to this SQLite database
+	- Indexed on miRNA, target and score for fast lookups''')
+filter_parser.add_argument('--chunk-size', type=int, default=100000, help='''
+	Number of miranda hits filtered together as one array (default=100000)''')
+
+parser = argparse.ArgumentParser(parents=[filter_parser, metrics.parser, checkpoint.parser],
+formatter_class=argparse.RawDescriptionHelpFormatter,
 description='''
-This script will take in grep '>>' miranda output and 
-filter out and sort sequences based on:
+This script will take in raw miranda output (or only its grep '>>'
+lines) and filter out and sort sequences based on:
 	1. Energy threshold
 	2. Score threshold
 	3. Near the 3'UTR 
 
 - Assumes there is only one location per transcript target
+- Each miRNA is written as soon as its run of consecutive hits is
+  ranked, so a miRNA whose hits are not consecutive in the miranda
+  output is written once per run (earlier versions kept only its last
+  run)
 
 Default usage:
 
@@ -23,22 +52,17 @@ Default usage:
 
 	TEMP: python3 ~/scripts/sort_miranda.py ctl.mirprof.fa.miranda.short YSA_transdecoder.gff3 all.miranda.sorted
 	TEST: python3 ~/scripts/sort_miranda.py test.miranda YSA_transdecoder.gff3 test.miranda.out -s 150
+	RESUMABLE: sort_miranda.py output.miranda transcripts.fa outfile.txt --checkpoint outfile.ckpt
 
 ///AUTHOR: Michelle Hwang
 ///DATE: 7/6/2016''')
 parser.add_argument('miranda', help = 'Name of output from miranda.')
 parser.add_argument('transdecoder', help = 'Name of transdecoder output of transcriptome')
 parser.add_argument('outfile', help = 'Name for output file')
-parser.add_argument('-e', '--energy', type=int, default=20, help='''
-	Energy threshold (default=20)
-	- e.g. remove those folds with larger energy values than |20|
-	- Most likely secondary structure has min free energy''')
-parser.add_argument('-s', '--score', type=int, default=100, help='''
-	Score threshold (default=100)
-	- e.g. remove those matches with scores less than 100''')
-
-args = parser.parse_args()
-wkdir = os.getcwd()
+parser.add_argument('-j', '--jobs', type=int, default=1, help='''
+	Number of processes parsing the miranda output (default=1)
+	- The file is split into byte ranges aligned to line starts
+	- Output is identical to a serial run''')
 
 # ------------------------------------------------------------------------------------------------
 
@@ -46,218 +70,450 @@ class MyError(Exception):
 	pass
 
 class Mirna:
-	def __init__(self, name):
+	"""Targets of one miRNA in parallel slots. Targets are ranked by
+	score, highest first.
+
+	With top_k, only the top_k best targets are kept while hits stream
+	in: heap holds (score, -arrival, slot) with the worst kept target at
+	its root, and a better target overwrites that slot. order holds the
+	arrival number of the target in each slot. offset is the input byte
+	offset just after the last hit added, where a resumed run continues."""
+
+	__slots__ = ('name', 'top_k', 'added', 'heap', 'order', 'coordinates',
+			'energies', 'scores', 'targets', 'ranks', 'offset')
+
+	def __init__(self, name, top_k=0):
 		self.name 			= name
+		self.top_k 			= top_k
+		self.added 			= 0 # Targets offered so far
+		self.heap 			= list()
+		self.order 			= array('l')
 		self.coordinates 	= list()
-		self.energies 		= list()
-		self.scores 		= list()
+		self.energies 		= array('d')
+		self.scores 		= array('d')
 		self.targets 		= list()
-		self.ranks 			= list()
+		self.ranks 			= array('l')
+		self.offset 		= 0
 
 	def add_target(self, target, energy, score, coordinate):
-		self.targets.append(target)
-		self.energies.append(energy)
-		self.scores.append(score)
-		self.coordinates.append(coordinate)
+		arrival = self.added
+		self.added += 1
+
+		if self.top_k <= 0 or len(self.targets) < self.top_k:
+			slot = len(self.targets)
+			self.targets.append(target)
+			self.energies.append(energy)
+			self.scores.append(score)
+			self.coordinates.append(coordinate)
+			self.order.append(arrival)
+			if self.top_k > 0:
+				heapq.heappush(self.heap, (score, -arrival, slot))
+			return
+
+		# Ties go to the earlier target, as a stable sort would
+		if score <= self.heap[0][0]:
+			return
+		slot = self.heap[0][2]
+		heapq.heapreplace(self.heap, (score, -arrival, slot))
+		self.targets[slot] 		= target
+		self.energies[slot] 	= energy
+		self.scores[slot] 		= score
+		self.coordinates[slot] 	= coordinate
+		self.order[slot] 		= arrival
+
+	def in_order(self):
+		"""Returns slots of kept targets in the order they were added."""
+		return sorted(range(len(self.targets)), key=self.order.__getitem__)
+
+	def merge(self, other):
+		"""Adds the kept targets of other, in their input order."""
+		for n in other.in_order():
+			self.add_target(other.targets[n], other.energies[n],
+					other.scores[n], other.coordinates[n])
+		self.offset = max(self.offset, other.offset)
 
 	def rank_targets(self):
-		self.ranks = [operator.itemgetter(0)(x) for x in sorted(enumerate(self.scores,1), key=operator.itemgetter(1))]
+		"""Puts kept targets back in input order and sets ranks[n] to
+		the rank of target n (1 = highest score)."""
+		slots 				= self.in_order()
+		self.targets 		= [self.targets[n] for n in slots]
+		self.coordinates 	= [self.coordinates[n] for n in slots]
+		self.energies 		= array('d', [self.energies[n] for n in slots])
+		self.scores 		= array('d', [self.scores[n] for n in slots])
+		self.order 			= array('l', [self.order[n] for n in slots])
+		self.heap 			= list()
+
+		ranked = sorted(range(len(self.targets)), key=lambda n: -self.scores[n])
+		self.ranks = array('l', [0]*len(ranked))
+		for (rank, n) in enumerate(ranked, 1):
+			self.ranks[n] = rank
 
 	def print_mirna(self):
 		print(self.name)
 
 
-# ------------------------------------------------------------------------------------------------
+# Summary of one miRNA vs transcript scan from a '>>' line, offset is the
+# input byte offset just after that line (0 if unknown)
+Hit = collections.namedtuple('Hit', ['mirna', 'target', 'score', 'energy',
+		'length', 'transcript_len', 'positions', 'alignments', 'offset'])
+
+# One alignment of a scan from a '>' line, query and ref are (start, end)
+Alignment = collections.namedtuple('Alignment', ['score', 'energy', 'query',
+		'ref', 'align_len', 'identity', 'similarity'])
+
+HIT_DTYPE = np.dtype([('mirna_id', np.int32), ('target_id', np.int32),
+		('score', np.float64), ('energy', np.float64),
+		('length', np.int32), ('transcript_len', np.int64), ('offset', np.int64)])
+
+SITE_DTYPE = np.dtype([('hit', np.int64), ('start', np.int64), ('end', np.int64)])
+
+
+class HitTable:
+	"""Columnar chunk of miranda hits.
+
+	hits holds one HIT_DTYPE row per '>>' line, with mirna_id and
+	target_id indexing the mirnas and targets name lists. sites holds
+	one SITE_DTYPE row per position, in hit order, with the row of
+	its hit in hits."""
+
+	def __init__(self, hits):
+		mirna_ids 	= dict()
+		target_ids 	= dict()
+		self.hits 	= np.zeros(len(hits), dtype=HIT_DTYPE)
+		self.hits['mirna_id'] 		= [mirna_ids.setdefault(h.mirna, len(mirna_ids)) for h in hits]
+		self.hits['target_id'] 		= [target_ids.setdefault(h.target, len(target_ids)) for h in hits]
+		self.hits['score'] 			= [h.score for h in hits]
+		self.hits['energy'] 		= [h.energy for h in hits]
+		self.hits['length'] 		= [h.length for h in hits]
+		self.hits['transcript_len'] = [h.transcript_len for h in hits]
+		self.hits['offset'] 		= [h.offset for h in hits]
+		self.mirnas 	= list(mirna_ids)
+		self.targets 	= list(target_ids)
+
+		counts 		= [len(h.positions) for h in hits]
+		self.sites 	= np.zeros(sum(counts), dtype=SITE_DTYPE)
+		self.sites['hit'] 	= np.repeat(np.arange(len(hits)), counts)
+		self.sites['start'] = [p for h in hits for p in h.positions]
+		self.sites['end'] 	= self.sites['start'] + self.hits['length'][self.sites['hit']]
+
+	def __len__(self):
+		return len(self.hits)
+
+	def records(self, keep):
+		"""Takes boolean array over sites. Yields tuples (mirna, target,
+		energy, score, coordinate, offset) of every hit with a site kept,
+		where coordinate is a list of (start, end) of its kept sites."""
+
+		rows 	= self.sites[keep]
+		bounds 	= np.flatnonzero(np.diff(rows['hit'])) + 1
+		starts 	= np.split(rows['start'], bounds)
+		ends 	= np.split(rows['end'], bounds)
+		hits 	= self.hits[rows['hit'][np.concatenate(([0], bounds))]] if len(rows) else self.hits[:0]
+
+		for i in range(0,len(hits),1):
+			yield (self.mirnas[hits['mirna_id'][i]],
+				   self.targets[hits['target_id'][i]],
+				   float(hits['energy'][i]),
+				   float(hits['score'][i]),
+				   list(zip(starts[i].tolist(), ends[i].tolist())),
+				   int(hits['offset'][i]))
 
 
-def print_time(start):
-	"""Prints time in hours, minutes, seconds since program elasped."""
-	stop = time.clock()
-	m, s = divmod(stop-start, 60)
-	h, m = divmod(m, 60)
-	print( '%d:%02d:%02d' % (h, m, s))
+# ------------------------------------------------------------------------------------------------
 
 
-def get_transdecoder_info():
+def get_transdecoder_info(path):
 	"""Takes transdecoder .gff3 output and takes 3'UTR information.
-	Returns a dictionary of transcripts with values in the form of
-	a tuple (pos1, pos2, strand + or -). Will only take best 3'UTR 
-	region."""
+	Returns a transdecoder.UtrIndex of every 3'UTR region of each
+	transcript."""
 
-	print(">>> Attempting to gather Transdecoder .gff3 info using grep.")
+	print(">>> Attempting to gather Transdecoder .gff3 3'UTR info.")
 
 	try:
-		lines = sub.getoutput("grep 'three_prime_UTR' "+args.transdecoder)
-		lines = lines.split('\n')
-		print(">>> Grep from Transdecoder gff file successful.")
-		print_time(start_time)
+		with metrics.stage('gff_load'):
+			threeprimes = transdecoder.load_utrs(path)
 	except IOError:
 		print('\tERROR: Transdecoder .gff3 file could not be found.')
-
-	threeprimes = dict()
-	duplicates = list()
-	current_transcript = None
-
-	for line in lines:
-		line 	= line.rstrip()
-		fields 	= line.split('\t')
-
-		transcript 	= fields[0]
-		pos1		= int(fields[3])
-		pos2 		= int(fields[4])
-		strand		= fields[6]
-
-		# Remove unlikely 3'UTRs
-		if (pos2-pos1) < 25:
-			continue 
-		elif current_transcript is transcript:
-			duplicates.append((pos1, pos2, strand, pos2-pos1))
-		else:
-			if current_transcript is not None:
-				# Picks hit with shortest 3'UTR
-				top_hit = sorted_dups = sorted(duplicates, key=operator.itemgetter(0))[0]
-				threeprimes[transcript] = top_hit
-				duplicates = list()
-			current_transcript = transcript 
-			duplicates.append((pos1, pos2, strand, pos2-pos1))
+		raise SystemExit
 
 	print(">>> 3'UTR information collected.")
-	print_time(start_time)
+	metrics.print_time()
 	return threeprimes
 
 
-def check_score(score):
+def filter_options(args):
+	"""Returns dict of the filter_parser options of args, as keyword
+	arguments of read_mirnas() and parse_mirnas()."""
+	return dict(score=args.score, energy=args.energy, chunk_size=args.chunk_size,
+			top_k=args.top_k)
+
+
+def check_score(score, threshold=100):
 	"""Returns false if target does not pass score threshold.
-	True otherwise."""
-	if args.score > score:
-		return False
-	return True
+	True otherwise. Takes a single score or an array of them."""
+	return np.asarray(score) >= threshold
 
 
-def check_energy(energy):
+def check_energy(energy, threshold=20):
 	"""Returns false if target does not pass energy threshold.
-	True otherwise."""
-	if args.energy < abs(energy):
-		return False
-	return True
-
-
-def check_coordinate(coordinate, threeprime, transcript_len):
-	"""Returns false if target does is not in 3'UTR.
-	Take in coordinate (length, pos) and threeprime info
-	in form of (start, end, strand, length).
-	True otherwise."""
-
-	target_start = threeprime[0]
-	target_end	 = threeprime[1]
-	strand 		 = threeprime[2]
-
-	for hit in coordinate:
-		if strand is '+':
-			mirna_start = hit[0]
-			mirna_end 	= hit[1]
-		elif strand is '-':
-			mirna_start = transcript_len - mirna_end
-			mirna_end 	= transcript_len - mirna_start
-		else:
-			raise MyException('Invalid strand. Must be + or -.')		
-
-		if ((mirna_start >= target_start) and (mirna_end <= target_end)):
-			return True
-	
-	print('\tWARNING: No hits were found in the 3 prime UTR region.')
-	return False
-
-
-def print_outfile(mirnas):
-	"""Formats and prints result outfile."""
-	outfile = open(args.outfile, 'w')
-	for m in mirnas: # for each mirna
-		for n in range(1,len(mirnas[m].targets),1):
-			co = mirnas[m].coordinates[n]
-			print(m, mirnas[m].ranks[n],
-					 mirnas[m].targets[n], 
-					 ", ".join([str(i[0]) for i in co]),
-					 mirnas[m].energies[n],
-					 mirnas[m].scores[n],
-					 sep="\t", end="\n", file=outfile)
-	outfile.close()
+	True otherwise. Takes a single energy or an array of them."""
+	return np.abs(energy) <= threshold
+
+
+def filter_hits(table, threeprimes, score=100, energy=20):
+	"""Applies score, energy and 3'UTR filters to a HitTable as whole
+	array masks. Returns boolean array over table.sites, True for
+	sites that pass every filter."""
+
+	scored 	= check_score(table.hits['score'], score)
+	folded 	= check_energy(table.hits['energy'], energy)
+	passed 	= scored & folded
+	keep 	= passed[table.sites['hit']]
+	metrics.count('hits_dropped_score', int(np.count_nonzero(~scored)))
+	metrics.count('hits_dropped_energy', int(np.count_nonzero(scored & ~folded)))
+
+	# If target location is not in the 3' UTR region
+	sites 	= table.sites[keep]
+	hits 	= table.hits[sites['hit']]
+	targets = [table.targets[i] for i in hits['target_id'].tolist()]
+	inside 	= threeprimes.contains(targets, sites['start'], sites['end'],
+			hits['transcript_len'], missing=True)
+	keep[keep] = inside
+	metrics.count('sites_dropped_utr', int(np.count_nonzero(~inside)))
+	return keep
+
+
+def read_miranda(handle, alignments=False):
+	"""Streams raw miranda output and yields one Hit per '>>' line.
+	Everything else is skipped, so output already filtered with
+	grep '>>' works too. If alignments is True, the '>' lines before
+	each '>>' line are parsed into Alignment tuples on the Hit. Hit
+	offsets are known if handle is a checkpoint.LineReader."""
+
+	aligned = list()
+
+	for line in handle:
+		if not line.startswith('>'):
+			continue
+		fields = line.rstrip().split('\t')
+
+		if not line.startswith('>>'):
+			if alignments:
+				aligned.append(Alignment(float(fields[2]), float(fields[3]),
+						tuple(map(int, fields[4].split())),
+						tuple(map(int, fields[5].split())),
+						int(fields[6]), fields[7], fields[8]))
+			continue
 
-# ------------------------------------------------------------------------------------------------
+		yield Hit(fields[0][2:], # Remove '>>'
+				fields[1],
+				float(fields[2]),
+				float(fields[3]),
+				int(fields[7]), # Length of mirna
+				int(fields[8]), # Length of target transcript
+				list(map(int, fields[9].split())), # Can have more than one
+				aligned,
+				getattr(handle, 'end', 0))
+		aligned = list()
+
+
+def read_hit_tables(hits, chunk_size):
+	"""Takes a stream of Hit tuples and yields HitTable chunks of up to
+	chunk_size hits, so memory stays bounded by the chunk size."""
+
+	chunk = list()
+	for hit in hits:
+		chunk.append(hit)
+		if len(chunk) >= chunk_size:
+			yield HitTable(chunk)
+			chunk = list()
+	if chunk:
+		yield HitTable(chunk)
+
+
+def read_range(path, start, end=None):
+	"""Returns checkpoint.LineReader over the lines of path that begin at
+	a byte offset in [start, end). A line straddling start belongs to the
+	range before."""
+
+	with open(path, 'rb') as fh:
+		if start > 0:
+			fh.seek(start-1)
+			fh.readline()
+		start = fh.tell()
+	return checkpoint.LineReader(path, start, end)
+
+
+def shard_ranges(path, shards, start=0):
+	"""Returns list of (start, end) byte ranges splitting path from byte
+	offset start on into at most shards pieces."""
+	size = os.path.getsize(path)
+	step = max(1, -(-(size-start) // shards))
+	return [(i, min(i+step, size)) for i in range(start, size, step)]
+
+
+def filter_records(lines, threeprimes, score=100, energy=20, chunk_size=100000):
+	"""Parses and filters miranda lines in HitTable chunks against the
+	3'UTR index threeprimes. Yields (mirna, target, energy, score,
+	coordinate, offset) of each passing hit."""
+	for table in read_hit_tables(read_miranda(lines), chunk_size):
+		metrics.count('miranda_hits', len(table))
+		with metrics.stage('filter'):
+			keep = filter_hits(table, threeprimes, score, energy)
+		for record in table.records(keep):
+			yield record
+
+
+def group_hits(records, top_k=0):
+	"""Takes (mirna, target, energy, score, coordinate, offset) tuples
+	and yields one unranked Mirna object per run of consecutive hits of
+	a miRNA."""
+	data = None # Temp container of Mirna object
+	for (mirna, target, energy, score, coordinate, offset) in records:
+		if data is None or data.name != mirna:
+			if data is not None:
+				yield data
+			data = Mirna(mirna, top_k)
+		data.add_target(target, energy, score, coordinate)
+		data.offset = offset
+	if data is not None:
+		yield data
 
-def main():
 
-	all_mirnas		= dict() # Mirna name, class object, STATIC
-	current_mirna 	= None 
-	data			= None # Temp container of Mirna object  
-
-	threeprimes = get_transdecoder_info()
-	miranda 	= open(args.miranda, 'r')
-	lines 		= miranda.readlines()
-
-	miranda.close()
-	print(">>> Miranda output collected.")
-	print_time(start_time)
-
-	print(">>> Reading Miranda lines.")
-	for line in lines:
-		line 	= line.rstrip()
-		fields 	= line.split('\t')
-
-		mirna 			= fields[0]
-		mirna			= mirna[2:] # Remove '>>'
-		target 			= fields[1]
-		score 			= float(fields[2])
-		energy 			= float(fields[3])
-		length 			= int(fields[7]) # Length of mirna
-		transcript_len  = int(fields[8]) # Length of target transcript
-		pos 		    = fields[9].lstrip()
-		pos				= pos.split() # Can have more than one
-		pos 			= list(map(int, pos)) # Change to int
-
-		coordinate = list()
-		for p in pos:
-			coordinate.append((p, p+length))
-
-		# If target does not pass energy or score threshold
-		if not check_score(score):
-			continue
-		if not check_energy(energy):
-			continue
+def parse_mirnas(lines, threeprimes, score=100, energy=20, chunk_size=100000, top_k=0):
+	"""Parses and filters miranda lines. Returns generator of unranked
+	Mirna objects, one per run of consecutive hits of a miRNA."""
+	return group_hits(filter_records(lines, threeprimes, score, energy, chunk_size), top_k)
 
-		# If target location is not in the 3' UTR region
-		for c in coordinate:
-			if ((c in threeprimes) and
-				(check_coordinate(c, threeprimes[target], transcript_len) is False)):
-				coordinate.remove(c)
-		if coordinate is None:
-			continue
 
-		# Build Mirna object
-		if current_mirna is None:
-			current_mirna = mirna
-			data = Mirna(current_mirna)
-		elif current_mirna != mirna:
-			data.rank_targets()
-			all_mirnas[data.name] = data # Add Mirna object
-			current_mirna = mirna
-			data = Mirna(current_mirna)
-		else:
-			pass
-		data.add_target(target, energy, score, coordinate)
+# State of a forked pool worker, set by init_worker()
+_worker = dict()
 
-	data.rank_targets()
-	all_mirnas[data.name] = data
+def init_worker(threeprimes):
+	"""Pool initializer. Keeps the 3'UTR index, which forked workers
+	inherit instead of unpickling, and starts the worker's metrics."""
+	_worker['threeprimes'] = threeprimes
+	metrics.reset()
 
+
+def parse_shard(task):
+	"""Takes tuple (path, start, end, options) and returns list of
+	unranked Mirna objects of that byte range, parsed with the
+	parse_mirnas() keyword arguments options, and the worker's
+	metrics.take()."""
+	(path, start, end, options) = task
+	lines = read_range(path, start, end)
+	try:
+		with metrics.stage('parse_shards'):
+			groups = list(parse_mirnas(lines, _worker['threeprimes'], **options))
+	finally:
+		lines.close()
+	return(groups, metrics.take())
+
+
+def read_mirnas(path, threeprimes, start=0, jobs=1, **options):
+	"""Yields unranked Mirna objects of the miranda output from byte
+	offset start on, one per run of consecutive hits of a miRNA in file
+	order, parsed with the parse_mirnas() keyword arguments options.
+	With jobs > 1, byte range shards are parsed and filtered in a forked
+	process pool and the groups of a miRNA cut by a shard edge are
+	joined."""
+
+	if jobs <= 1:
+		lines = read_range(path, start)
+		try:
+			for data in parse_mirnas(lines, threeprimes, **options):
+				yield data
+		finally:
+			lines.close()
+		return
+
+	# Fork so workers inherit the 3'UTR index instead of pickling it
+	pool = multiprocessing.get_context('fork').Pool(jobs, initializer=init_worker,
+			initargs=(threeprimes,))
+	tasks = [(path, a, b, options) for (a, b) in shard_ranges(path, 4*jobs, start)]
+	data = None
+	try:
+		for (groups, taken) in pool.imap(parse_shard, tasks):
+			metrics.merge(taken)
+			for group in groups:
+				if data is not None and data.name == group.name:
+					data.merge(group)
+					continue
+				if data is not None:
+					yield data
+				data = group
+		if data is not None:
+			yield data
+	finally:
+		pool.terminate()
+
+
+def write_mirna(data, outfile, db=None):
+	"""Prints ranked targets of one Mirna object to outfile, and adds
+	them to ResultDB db if given."""
+	m = data.name
+	rows = list()
+	for n in range(0,len(data.targets),1):
+		co = ", ".join([str(i[0]) for i in data.coordinates[n]])
+		print(m, data.ranks[n],
+				 data.targets[n], 
+				 co,
+				 data.energies[n],
+				 data.scores[n],
+				 sep="\t", end="\n", file=outfile)
+		rows.append((m, data.targets[n], data.ranks[n], co,
+				data.energies[n], data.scores[n], None, None, None))
+	if db is not None:
+		db.add(rows)
+
+
+# ------------------------------------------------------------------------------------------------
+
+def main():
+
+	threeprimes = get_transdecoder_info(args.transdecoder)
+
+	ckpt 	= None
+	start 	= 0
+	if args.checkpoint:
+		(ckpt, start, outfile) = checkpoint.start_run(args, 'sort_miranda',
+				[args.miranda, args.transdecoder], args.outfile)
+	else:
+		outfile = open(args.outfile, 'w')
+	db = None
+	if args.sqlite:
+		db = resultdb.ResultDB(args.sqlite, 'sort_miranda', vars(args))
+
+	# Each miRNA group is ranked and written as soon as it closes
+	print(">>> Reading, ranking and writing Miranda lines by miRNA.")
+	mirnas = read_mirnas(args.miranda, threeprimes, start, args.jobs, **filter_options(args))
+	for data in metrics.timed(mirnas, 'parse'):
+		with metrics.stage('rank'):
+			data.rank_targets()
+		with metrics.stage('write'):
+			write_mirna(data, outfile, db)
+			if ckpt is not None:
+				ckpt.save(data.offset, outfile)
+		metrics.count('mirnas')
+
+	outfile.close()
+	if ckpt is not None:
+		ckpt.finish()
+	if db is not None:
+		with metrics.stage('write'):
+			db.close()
 	print(">>> Target filtering and ranking completed.")
-	print_outfile(all_mirnas)
+	metrics.print_time()
 
 
 if __name__ == "__main__":
-	start_time = time.clock()
-	main()
+	args = parser.parse_args()
+	checkpoint.check_args(parser, args)
+	wkdir = os.getcwd()
+	metrics.run(main, args, 'sort_miranda')
 	print(">>> Script complete.")
-	print_time(start_time)
+	metrics.print_time()
 
 
 
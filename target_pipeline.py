@@ -0,0 +1,147 @@
+#!/usr/local/python/3.4.0/bin/python3
+
+import argparse
+import metrics
+import resultdb
+import sort_miranda
+import sort_RNAfold
+
+parser = argparse.ArgumentParser(parents=[sort_miranda.filter_parser, metrics.parser],
+formatter_class=argparse.RawDescriptionHelpFormatter,
+description='''
+This script runs miranda target filtering and RNAfold accessibility
+scoring in a single pass. miranda hits are streamed through the
+sort_miranda.py score, energy and 3'UTR filters, every kept site is
+scored against the RNAfold structure of its transcript as in
+sort_RNAfold.py, and the targets of each miRNA are ranked by score and
+written to one combined table. The 3'UTR index and the RNAfold structure
+store are loaded once and no intermediate files are written.
+
+Output columns:
+
+	mirna rank target positions energy score mfe
+	max_consec_loops max_consec_stems ratio
+
+The structure columns describe the most accessible site of the hit (the
+lowest tuple, as ranked by sort_RNAfold.py) and are NA if the transcript
+has no RNAfold record.
+
+Default usage:
+
+	target_pipeline.py output.miranda rnafold.fa transdecoder.gff3 outfile.txt
+''')
+parser.add_argument('miranda', help = 'Name of output from miranda.')
+parser.add_argument('fasta', help = 'Name of hairpin file output from RNAfold.')
+parser.add_argument('transdecoder', help = 'Name of transdecoder output of transcriptome')
+parser.add_argument('outfile', help = 'Name for output file')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='''
+	Number of processes parsing the miranda output (default=1)''')
+parser.add_argument('--index', default=None, help='''
+	Name of sidecar index for the RNAfold file (default=<fasta>.idx)''')
+parser.add_argument('--cache-size', type=int, default=1000, help='''
+	Number of parsed transcript structures kept in memory (default=1000)''')
+
+HEADER = ['mirna', 'rank', 'target', 'positions', 'energy', 'score', 'mfe',
+		'max_consec_loops', 'max_consec_stems', 'ratio']
+
+# ------------------------------------------------------------------------------------------------
+
+def score_accessibility(data, folds):
+	"""Scores every kept site of Mirna object data against the RNAfold
+	structure of its target from sort_RNAfold.FoldCache folds, one
+	vectorized call per target. Returns
+	tuple (structures, mfes) with, per target, the lowest structure
+	tuple over its sites and the transcript MFE, None if unknown."""
+
+	sites = dict() # target, indices of its hits
+	for n in range(0,len(data.targets),1):
+		sites.setdefault(data.targets[n], list()).append(n)
+
+	structures 	= [None]*len(data.targets)
+	mfes 		= [None]*len(data.targets)
+	for target in sites:
+		if target not in folds.hairpins:
+			continue
+		profile = folds.get(target)
+		windows = list()
+		owners 	= list()
+		for n in sites[target]:
+			for (start, end) in data.coordinates[n]:
+				windows.append((start-1, end-1))
+				owners.append(n)
+		for (n, structure) in zip(owners, profile.metrics(windows)):
+			if structures[n] is None or structure < structures[n]:
+				structures[n] = structure
+			mfes[n] = profile.energy
+
+	return(structures, mfes)
+
+
+def print_out(data, structures, mfes, outfile, db=None):
+	"""Prints ranked and scored targets of one Mirna object, and adds
+	them to ResultDB db if given."""
+
+	rows = list()
+	for n in range(0,len(data.targets),1):
+		co = ", ".join([str(i[0]) for i in data.coordinates[n]])
+		structure = structures[n] or ('NA', 'NA', 'NA')
+		print(data.name, data.ranks[n],
+				 data.targets[n],
+				 co,
+				 data.energies[n],
+				 data.scores[n],
+				 mfes[n] or 'NA',
+				 structure[0],
+				 structure[1],
+				 structure[2],
+				 sep="\t", end="\n", file=outfile)
+		rows.append((data.name, data.targets[n], data.ranks[n], co,
+				data.energies[n], data.scores[n]) + tuple(structures[n] or (None, None, None)))
+
+	if db is not None:
+		db.add(rows)
+
+# ------------------------------------------------------------------------------------------------
+
+def main():
+
+	threeprimes = sort_miranda.get_transdecoder_info(args.transdecoder)
+
+	with metrics.stage('rnafold_index'):
+		hairpins 	= sort_RNAfold.HairpinStore(args.fasta, args.index)
+	folds 			= sort_RNAfold.FoldCache(hairpins, args.cache_size)
+	print(">>> RNAfold output information collected.")
+
+	outfile = open(args.outfile, 'w')
+	print(*HEADER, sep="\t", end="\n", file=outfile)
+	db = None
+	if args.sqlite:
+		db = resultdb.ResultDB(args.sqlite, 'target_pipeline', vars(args))
+
+	# Each miRNA group is filtered, scored, ranked and written as it closes
+	print(">>> Reading Miranda lines.")
+	mirnas = sort_miranda.read_mirnas(args.miranda, threeprimes, jobs=args.jobs,
+			**sort_miranda.filter_options(args))
+	for data in metrics.timed(mirnas, 'parse'):
+		with metrics.stage('rank'):
+			data.rank_targets()
+		with metrics.stage('fold_scoring'):
+			(structures, mfes) = score_accessibility(data, folds)
+		with metrics.stage('write'):
+			print_out(data, structures, mfes, outfile, db)
+
+	outfile.close()
+	if db is not None:
+		db.close()
+	hairpins.close()
+	(hits, misses) = folds.counts()
+	metrics.count('fold_cache_hits', hits)
+	metrics.count('fold_cache_misses', misses)
+	print(">>> Fold cache: %d hits, %d misses." % (hits, misses))
+
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+	metrics.run(main, args, 'target_pipeline')
+	print(">>> Script complete.")
+	metrics.print_time()
@@ -0,0 +1,210 @@
+"""
+Shared TransDecoder .gff3 3'UTR loader used by sort_miranda.py and
+sort_RNAfold.py. The .gff3 file is streamed once in process and every
+3'UTR region is kept in a per-transcript interval index that answers
+"is this site inside any 3'UTR" for many sites at once.
+
+The parsed table is saved next to the .gff3 as a binary NumPy cache
+(<gff3>.utr.npz) and reloaded while the file fingerprint still matches.
+"""
+
+import hashlib
+import os
+import sys
+import tempfile
+import zipfile
+from contextlib import contextmanager
+import numpy as np
+
+MIN_UTR_LENGTH 	= 25 # Remove unlikely 3'UTRs shorter than this
+CACHE_VERSION 	= 1
+CACHE_SAMPLE 	= 1 << 20 # Bytes hashed from each end of the .gff3
+
+# ------------------------------------------------------------------------------------------------
+
+class UtrIndex:
+	"""3'UTR regions of each transcript stored as flat arrays.
+
+	Regions of names[i] are rows offsets[i] to offsets[i+1] of starts,
+	ends and minus (True for - strand)."""
+
+	def __init__(self, names, offsets, starts, ends, minus):
+		self.names 		= list(names)
+		self.offsets 	= np.asarray(offsets, dtype=np.int64)
+		self.starts 	= np.asarray(starts, dtype=np.int64)
+		self.ends 		= np.asarray(ends, dtype=np.int64)
+		self.minus 		= np.asarray(minus, dtype=bool)
+		self.rows 		= dict() # transcript, (first row, last row + 1)
+		for i in range(0,len(self.names),1):
+			self.rows[self.names[i]] = (int(self.offsets[i]), int(self.offsets[i+1]))
+
+	def __contains__(self, transcript):
+		return transcript in self.rows
+
+	def __len__(self):
+		return len(self.names)
+
+	def regions(self, transcript):
+		"""Returns list of tuples (start, end, strand) of transcript."""
+		(first, last) = self.rows.get(transcript, (0, 0))
+		return [(int(self.starts[i]), int(self.ends[i]), '-' if self.minus[i] else '+')
+				for i in range(first, last, 1)]
+
+	def contains(self, transcripts, starts, ends, lengths, missing=False):
+		"""Tests many sites against the 3'UTRs of their transcripts at once.
+
+		Takes equal length sequences of transcript IDs, site starts, site
+		ends and transcript lengths. On - strand UTRs the site is flipped
+		to (length - end, length - start) before comparing. Returns a
+		boolean array, True where the site lies inside any 3'UTR of its
+		transcript. Sites on transcripts without a 3'UTR get missing."""
+
+		n 		= len(transcripts)
+		starts 	= np.asarray(starts, dtype=np.int64).reshape(n)
+		ends 	= np.asarray(ends, dtype=np.int64).reshape(n)
+		lengths = np.asarray(lengths, dtype=np.int64).reshape(n)
+
+		rows 	= [self.rows.get(t, (0, 0)) for t in transcripts]
+		first 	= np.array([r[0] for r in rows], dtype=np.int64)
+		count 	= np.array([r[1]-r[0] for r in rows], dtype=np.int64)
+
+		# One (site, region) pair per 3'UTR of the site's transcript
+		site 	= np.repeat(np.arange(n), count)
+		row 	= np.repeat(first - (np.cumsum(count) - count), count) + np.arange(int(count.sum()))
+		s 		= starts[site]
+		e 		= ends[site]
+		minus 	= self.minus[row]
+		s 		= np.where(minus, lengths[site] - ends[site], s)
+		e 		= np.where(minus, lengths[site] - starts[site], e)
+		hit 	= (s >= self.starts[row]) & (e <= self.ends[row])
+
+		inside = np.bincount(site, weights=hit, minlength=n) > 0
+		if missing:
+			inside |= (count == 0)
+		return inside
+
+# ------------------------------------------------------------------------------------------------
+
+def fingerprint(path):
+	"""Returns int64 array (version, size, mtime_ns) and a digest of the
+	first and last CACHE_SAMPLE bytes of path. Hashing only the ends keeps
+	the check fast on multi-GB annotations while still catching edits
+	that preserve size and mtime."""
+
+	stat = os.stat(path)
+	digest = hashlib.blake2b(digest_size=16)
+	with open(path, 'rb') as fh:
+		digest.update(fh.read(CACHE_SAMPLE))
+		if stat.st_size > CACHE_SAMPLE:
+			fh.seek(max(CACHE_SAMPLE, stat.st_size-CACHE_SAMPLE))
+			digest.update(fh.read(CACHE_SAMPLE))
+	stamp = np.array([CACHE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+	return(stamp, np.frombuffer(digest.digest(), dtype=np.uint8))
+
+
+@contextmanager
+def replace_file(path, mode='w', sync=False):
+	"""Yields a file opened on a unique temp file next to path, which
+	atomically replaces path once the with block completes, so concurrent
+	writers never share a file and readers never see a partial one. The
+	temp file is removed if the block raises. With sync, the file and then
+	its directory are fsynced so the replacement survives a crash."""
+
+	(fd, tmp) = tempfile.mkstemp(prefix=os.path.basename(path)+'.', suffix='.tmp',
+			dir=os.path.dirname(os.path.abspath(path)))
+	try:
+		with os.fdopen(fd, mode) as fh:
+			yield fh
+			if sync:
+				fh.flush()
+				os.fsync(fh.fileno())
+		os.chmod(tmp, 0o644)
+		os.replace(tmp, path)
+	except BaseException:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+	if sync:
+		fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+def fsync_dir(path):
+	"""Flushes the entries of directory path, such as a rename, to disk."""
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+def load_utrs(path, cache=True):
+	"""Returns UtrIndex of path, from its binary cache if it is current.
+	Otherwise parses the .gff3 with parse_utrs() and rewrites the cache.
+	A cache that cannot be read or written is ignored."""
+
+	cache_path 		= path+'.utr.npz'
+	(stamp, digest) = fingerprint(path)
+
+	if cache:
+		try:
+			with np.load(cache_path, allow_pickle=False) as saved:
+				if (np.array_equal(saved['stamp'], stamp) and
+					np.array_equal(saved['digest'], digest)):
+					names = saved['names'].tobytes().decode()
+					names = names.split('\n') if names else list()
+					return UtrIndex(names, saved['offsets'],
+							saved['starts'], saved['ends'], saved['minus'])
+		except (IOError, OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+			pass
+
+	index = parse_utrs(path)
+
+	if cache:
+		try:
+			with replace_file(cache_path, 'wb') as fh:
+				np.savez(fh, stamp=stamp, digest=digest,
+						names=np.frombuffer('\n'.join(index.names).encode(), dtype=np.uint8),
+						offsets=index.offsets, starts=index.starts,
+						ends=index.ends, minus=index.minus)
+		except (IOError, OSError):
+			print('\tWARNING: 3\'UTR cache '+cache_path+' could not be written.', file=sys.stderr)
+
+	return index
+
+
+def parse_utrs(path):
+	"""Streams TransDecoder .gff3 output and collects 3'UTR regions.
+	Keeps every three_prime_UTR feature of at least MIN_UTR_LENGTH.
+	Raises ValueError on a strand other than + or -.
+	Returns a UtrIndex."""
+
+	regions = dict() # transcript, list of (start, end, minus)
+
+	with open(path, 'r') as gff:
+		for line in gff:
+			if line.startswith('#'):
+				continue
+			fields = line.rstrip('\r\n').split('\t')
+			if len(fields) < 9 or fields[2] != 'three_prime_UTR':
+				continue
+
+			transcript 	= fields[0]
+			pos1 		= int(fields[3])
+			pos2 		= int(fields[4])
+			strand 		= fields[6]
+
+			if strand not in ('+', '-'):
+				raise ValueError('Invalid strand '+strand+' for '+transcript+'. Must be + or -.')
+			if (pos2-pos1) < MIN_UTR_LENGTH:
+				continue
+			regions.setdefault(transcript, list()).append((pos1, pos2, strand == '-'))
+
+	names 	= list(regions)
+	offsets = [0]
+	rows 	= list()
+	for transcript in names:
+		rows.extend(regions[transcript])
+		offsets.append(len(rows))
+
+	return UtrIndex(names, offsets,
+			[r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows])